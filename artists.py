@@ -1,7 +1,7 @@
 import numpy as np
 from matplotlib.patches import  Rectangle
-LAMBDA0 = 400
-LAMBDAf = 680
+import stack
+from stack import LAMBDA0, LAMBDAf, WAVELENGTHS
 def wavelength_to_rgb(wavelength, gamma=0.8):
     '''This converts a given wavelength of light to an 
     approximate RGB color value. The wavelength must be given
@@ -45,20 +45,38 @@ def wavelength_to_rgb(wavelength, gamma=0.8):
         B = 0.0
     return R,G,B
 
-class Particle(object):
+WAVELENGTH_COLORS = np.array([wavelength_to_rgb(w) for w in WAVELENGTHS])
+
+def wavelengths_to_rgb(wavelengths):
+    '''wavelength_to_rgb for an array of wavelengths, as an (N, 3) array'''
+    wavelengths = np.asarray(wavelengths,dtype=float)
+    col = wavelengths-LAMBDA0
+    on_grid = (col == np.floor(col))&(col >= 0)&(col < len(WAVELENGTHS))
+    if on_grid.all():
+        return WAVELENGTH_COLORS[col.astype(np.intp)]
+    return np.array([wavelength_to_rgb(w) for w in wavelengths]).reshape(-1,3)
+
+class _Particle(object):
+    """One photon, drawn as its own artist. The kinematics are kept as
+    plain floats, which are smaller and faster than numpy scalars and give
+    the same results. Subclasses choose where the attributes live.
+    """
+    __slots__ = ()
+
     def __init__(self,master,id_,x=0,y=0,theta=0,v=0,polarization = 1,
             wavelength=700.):
         self._id = id_
         self.master = master
-        self.x = x
-        self.y = y
-        self.theta = theta
-        self.v = v
-        self.vx = np.cos(theta)*v
-        self.vy = np.sin(theta)*v
+        self.x = float(x)
+        self.y = float(y)
+        self.theta = float(theta)
+        self.v = float(v)
+        self.vx = float(np.cos(theta)*v)
+        self.vy = float(np.sin(theta)*v)
+        self.launched_down = self.vy < 0
         self.bounces = 0
         self.polarization = polarization
-        self.wavelength = wavelength
+        self.wavelength = float(wavelength)
         color = wavelength_to_rgb(self.wavelength)
 
         self._artist, = self.master.axes.plot(self.x,self.y,'o',color=color)
@@ -83,16 +101,16 @@ class Particle(object):
             else:
                 pct_move = (layer.yf-self.y)/self.vy
                 assert pct_move > 0 and pct_move < 1
-            self.y += self.vy*pct_move
-            self.x += self.vx*pct_move
-            self.theta = np.pi/2-np.arcsin(new_sin)
+            self.y += float(self.vy*pct_move)
+            self.x += float(self.vx*pct_move)
+            self.theta = float(np.pi/2-np.arcsin(new_sin))
             if up:
                 self.v = self.v * self.nprev/self.n
             else:
                 self.v = self.v * self.nnext/self.n
                 self.theta *=-1
-            self.vx = np.cos(self.theta)*self.v
-            self.vy = np.sin(self.theta)*self.v
+            self.vx = float(np.cos(self.theta)*self.v)
+            self.vy = float(np.sin(self.theta)*self.v)
         else:
             self.reflect(layer,up)
 
@@ -143,11 +161,11 @@ class Particle(object):
             pct_move = (layer.y0-self.y)/self.vy
         else:
             pct_move = -(self.y-layer.yf)/self.vy
-        self.y += self.vy*pct_move
-        self.x += self.vx*pct_move
+        self.y += float(self.vy*pct_move)
+        self.x += float(self.vx*pct_move)
         self.theta = -self.theta
-        self.vx = np.cos(self.theta)*self.v
-        self.vy = np.sin(self.theta)*self.v
+        self.vx = float(np.cos(self.theta)*self.v)
+        self.vy = float(np.sin(self.theta)*self.v)
 
     def monteCarloRefract(self,layer,up=True):
         #TODO
@@ -155,11 +173,40 @@ class Particle(object):
             r = self.parallelPolarizedReflectivity(layer,up)
         else:
             r = self.perpendicularPolarizedReflectivity(layer,up)
-        if np.random.rand() < r:
+        reflected = self.master.rng.random() < r
+        profiler = getattr(self.master,'profiler',None)
+        if profiler is not None:
+            profiler.count('interface_hits')
+            if reflected:
+                profiler.count('reflections')
+                if np.isnan(self.getThetaIThetaF(layer,up)[1]):
+                    profiler.count('total_internal_reflections')
+        if reflected:
             self.reflect(layer,up)
             return True
 
     def checkForChangeLayers(self):
+        #only the layers either side of the current one can be entered
+        stack = self.master.stack
+        self._layer = stack.layer_index(self.y,getattr(self,'_layer',None))
+        if not stack.contiguous:
+            return self._checkEveryLayer()
+        k = self._layer+1 if self.vy < 0 else self._layer-1
+        if not 0 <= k < len(stack):
+            return
+        layer = stack[k]
+        if self.enteringFromAbove(layer):
+            self.n,self.nprev,self.nnext = \
+                    layer.ns_for_lambda(self.wavelength)
+            if not self.monteCarloRefract(layer):
+                self.moveToNewLayer(layer)
+        elif self.enteringFromBelow(layer):
+            self.n,self.nprev,self.nnext = \
+                    layer.ns_for_lambda(self.wavelength)
+            if not self.monteCarloRefract(layer,up=False):
+                self.moveToNewLayer(layer,up=False)
+
+    def _checkEveryLayer(self):
         for layer in self.master.layers:
             if self.enteringFromAbove(layer):
                 self.n,self.nprev,self.nnext = \
@@ -189,14 +236,14 @@ class Particle(object):
         self.checkForChangeLayers()
         self.x+=self.vx
         self.y+=self.vy
-        self._artist.set_xdata(self.x)
-        self._artist.set_ydata(self.y)
+        #Line2D data has to be a sequence, even for one point
+        self._artist.set_data([self.x],[self.y])
 
     def _delete_self(self):
         if not self._gone:
             self._gone = True
             self._artist.remove()
-            self.master.remove_particle(self._id)
+            self.master.remove_particle(self)
 
     def delete_if_gone(self):
         if(self.x > self.master.axes.get_xlim()[1] or 
@@ -206,51 +253,76 @@ class Particle(object):
             self._delete_self()
 
 
-class Layer(object):
+class Particle(_Particle):
+    """A photon keeping its attributes in a __dict__"""
+
+
+class SlottedParticle(_Particle):
+    """A Particle keeping its attributes in __slots__ instead, which saves
+    the per-instance dict when tens of thousands are in flight
+    """
+    __slots__ = ('_id','master','x','y','theta','v','vx','vy',
+            'launched_down','bounces','polarization','wavelength','n',
+            'nprev','nnext','_layer','_artist','_gone','_slot')
+
+
+class ParticlePool(object):
+    """Particles in flight, in a list of slots. A particle that leaves
+    frees its slot for the next one, so removal is O(1) and the list only
+    grows, doubling, once every slot is taken. Particles may leave while
+    the pool is being iterated over.
+    """
+    def __init__(self,capacity=64):
+        self._slots = [None]*capacity
+        self._free = list(range(capacity-1,-1,-1))
+
+    def __len__(self):
+        return len(self._slots)-len(self._free)
+
+    def __iter__(self):
+        slots = self._slots
+        for i in range(len(slots)):
+            if slots[i] is not None:
+                yield slots[i]
+
+    def add(self,particle):
+        if not self._free:
+            size = len(self._slots)
+            self._slots.extend([None]*max(size,1))
+            self._free.extend(range(len(self._slots)-1,size-1,-1))
+        particle._slot = self._free.pop()
+        self._slots[particle._slot] = particle
+
+    def remove(self,particle):
+        self._slots[particle._slot] = None
+        self._free.append(particle._slot)
+
+
+class _Layer(stack.Layer):
+    """A stack.Layer that draws itself as a Rectangle on its master's axes"""
+    __slots__ = ()
+
     def __init__(self,n,y0,yf,nprev = 1,nnext = 1,dndlambda=1e-3):
-        self.n = n
-        self.nprev = nprev
-        self.nnext = nnext
+        stack.Layer.__init__(self,n,y0,yf,nprev,nnext,dndlambda)
         self.color = (1./(n**2),1./(n**2),1./np.sqrt(n))
         self._artist = Rectangle((-1,yf),2,y0-yf,fill=True,facecolor=self.color)
-        self.y0 = y0
-        self.yf = yf
-        #per nm
-        self.dndlambda = dndlambda
-
 
     def set_master(self,master):
         self.master = master
         self.master.axes.add_artist(self._artist)
 
-    def contains(self,y):
-        return y >= self.yf and y < self.y0
-
-    def ns_for_lambda(self,lambda_):
-        def new_n_pos(n):
-            return max(1,n+(lambda_-LAMBDA0)*self.dndlambda)
-        def new_n_neg(n):
-            return max(1,n+(LAMBDAf-lambda_)*-self.dndlambda)
-        
-        new_n = new_n_pos if self.dndlambda > 0 else new_n_neg
-        n = 1 if self.n == 1 else new_n(self.n)
-        nprev = 1 if self.nprev == 1 else new_n(self.nprev) 
-        nnext = 1 if self.nnext == 1 else new_n(self.nnext)
-        return n,nprev,nnext
-
     def remove(self):
         self._artist.remove()
 
 
-def buildLayers(ns,dndlambda=0.001):
-    ys = np.linspace(0,-0.96,1+len(ns))
-    layers = [Layer(1,1,0,1,ns[0],dndlambda)]
-    for i,n in enumerate(ns):
-        prev_n = 1 if i == 0 else ns[i-1]
-        next_n = 1 if i == len(ns)-1 else ns[i+1]
-        layers.append(Layer(n,ys[i],ys[i+1],prev_n,next_n,dndlambda))
+class Layer(_Layer):
+    """A drawn layer keeping its attributes in a __dict__"""
+
 
-    layers.append(Layer(1,-.96,-1,ns[-1],1,dndlambda))
+class SlottedLayer(_Layer):
+    """A drawn layer keeping its attributes in __slots__"""
+    __slots__ = ('color','_artist','master')
 
-    return layers
 
+def buildLayers(ns,dndlambda=0.001,thicknesses=None,layer_class=Layer):
+    return stack.buildLayers(ns,dndlambda,layer_class,thicknesses)
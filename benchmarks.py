@@ -0,0 +1,268 @@
+"""Benchmarks of the photon engines on canned scenarios.
+
+Each scenario runs headlessly through simulation.Simulation and reports
+photons per second, nanoseconds per interface interaction and the peak
+memory allocated during the run, as JSON so the results of two builds
+can be compared:
+
+    $ python benchmarks.py --output before.json
+    $ python benchmarks.py --compare before.json
+
+--compare exits with status 1 if a scenario got more than --tolerance
+slower. --memory adds the bytes each live photon takes as a Particle, a
+SlottedParticle and in a PhotonBatch. Timings are the best of --repeat
+runs. Interactions and memory are measured on a separate run, under
+tracemalloc and a profiling.Profiler, so neither slows the timed ones.
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+import numpy as np
+from stack import VACCUM_SPEED, LayerStack, buildLayers, bragg_mirror
+from simulation import Simulation
+from photon_batch import PhotonBatch
+from profiling import Profiler
+from random_buffer import BIT_GENERATORS, RandomBuffer
+
+
+def _light_guide(sim):
+    #start inside a thin n=2 slab heading down at 45°, past its 30° critical
+    #angle, so every photon bounces along it until it leaves the side
+    sim.x, sim.y, sim.theta = .9, -.01, np.pi/4
+    sim.n0 = 2.
+
+
+_MIRROR_NS, _MIRROR_THICKNESSES = bragg_mirror(2.3, 1.38, 250)
+
+#keyword arguments for make_simulation, and how many photons to run
+SCENARIOS = {
+    'normal_incidence': dict(ns=[1.5], angle=0, photons=200000),
+    'total_internal_reflection': dict(ns=[2.], thicknesses=[.02], depth=None,
+        setup=_light_guide, photons=20000),
+    'water_on_glass': dict(ns=[1.33, 1.5], photons=200000),
+    'mirror_500': dict(ns=_MIRROR_NS, thicknesses=_MIRROR_THICKNESSES,
+        angle=30, photons=2000),
+    'broadband': dict(ns=[1.33], angle=30, wavelength_spec='broadband',
+        photons=200000),
+}
+
+
+def make_simulation(ns, thicknesses=None, depth=.96, angle=45,
+        wavelength_spec='monochrome', setup=None, seed=0,
+        propagation='event', photons=None, profiler=None,
+        bit_generator='PCG64'):
+    '''The Simulation of a scenario; `photons` is ignored'''
+    layers = buildLayers(ns, thicknesses=thicknesses, depth=depth)
+    sim = Simulation(layers, angle, wavelength_spec, seed,
+            propagation=propagation, profiler=profiler,
+            bit_generator=bit_generator)
+    if setup is not None:
+        setup(sim)
+    return sim
+
+
+def run_scenario(name, n_photons=None, propagation='event', repeat=3,
+        seed=0, bit_generator='PCG64'):
+    '''Benchmark one scenario, returning a JSON-able dict of its results'''
+    scenario = SCENARIOS[name]
+    if n_photons is None:
+        n_photons = scenario['photons']
+    #one-off costs, like compiling the jit kernel, aren't part of a run
+    make_simulation(seed=seed, propagation=propagation,
+            bit_generator=bit_generator, **scenario).run(1)
+    profiler = Profiler()
+    sim = make_simulation(seed=seed, propagation=propagation,
+            profiler=profiler, bit_generator=bit_generator, **scenario)
+    tracemalloc.start()
+    sim.run(n_photons)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    times = []
+    for _ in range(repeat):
+        sim = make_simulation(seed=seed, propagation=propagation,
+                bit_generator=bit_generator, **scenario)
+        start = time.perf_counter()
+        sim.run(n_photons)
+        times.append(time.perf_counter()-start)
+    best = min(times)
+    interactions = profiler.counters.get('interface_hits', 0)
+    return {
+        'photons': n_photons,
+        'propagation': propagation,
+        'bit_generator': bit_generator,
+        'interactions': interactions,
+        'reflections': profiler.counters.get('reflections', 0),
+        'total_internal_reflections':
+            profiler.counters.get('total_internal_reflections', 0),
+        'seconds': best,
+        'median_seconds': float(np.median(times)),
+        'photons_per_second': n_photons/best,
+        'ns_per_interaction': 1e9*best/max(interactions, 1),
+        'peak_memory_bytes': peak,
+        'reflection_counts': sim.reflection_counts,
+    }
+
+
+def run_benchmarks(names=None, scale=1., propagation='event', repeat=3,
+        seed=0, bit_generator='PCG64'):
+    '''run_scenario over `names` (every scenario by default), with each
+    scenario's photon count multiplied by scale
+    '''
+    results = {}
+    for name in names or SCENARIOS:
+        n_photons = max(1, int(SCENARIOS[name]['photons']*scale))
+        results[name] = run_scenario(name, n_photons, propagation, repeat,
+                seed, bit_generator)
+    return {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'scenarios': results,
+    }
+
+
+class _NoArtist(object):
+    def set_data(self, x, y):
+        pass
+
+    def remove(self):
+        pass
+
+
+class _HeadlessCanvas(object):
+    """Just enough of the GUI's canvas for Particles to move, sharing
+    one artist that draws nothing
+    """
+    def __init__(self, layers):
+        self.layers = layers
+        self.stack = LayerStack(layers)
+        self.axes = self
+        self.profiler = None
+        self.rng = RandomBuffer(0)
+        self._artist = _NoArtist()
+
+    def plot(self, *args, **kwargs):
+        return (self._artist,)
+
+    def get_xlim(self):
+        return (-1, 1)
+
+    get_ylim = get_xlim
+
+    def remove_particle(self, particle):
+        pass
+
+
+def particle_memory(count=50000, steps=3):
+    '''Bytes per live photon of each photon model, holding `count` photons
+    in a water layer after `steps` moves. Particles share one artist, so
+    this is the photon itself without its matplotlib Line2D.
+    '''
+    #artists needs matplotlib, which the engine benchmarks don't
+    from artists import Particle, SlottedParticle
+    rng = np.random.default_rng(0)
+    x = rng.uniform(-.9, .9, count).tolist()
+    y = rng.uniform(-.9, -.1, count).tolist()
+    theta = rng.uniform(0, 2*np.pi, count).tolist()
+    canvas = _HeadlessCanvas(buildLayers([1.33]))
+    memory = {}
+    for particle_class in (Particle, SlottedParticle):
+        tracemalloc.start()
+        particles = [particle_class(canvas, i, x[i], y[i], theta[i],
+            -VACCUM_SPEED/1.33, i%2, 670.) for i in range(count)]
+        for _ in range(steps):
+            for particle in particles:
+                particle.move()
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        memory[particle_class.__name__] = size/count
+        del particles
+    tracemalloc.start()
+    photons = PhotonBatch(canvas.stack, capacity=count)
+    photons.emit(x, y, theta, -VACCUM_SPEED/1.33, 670., np.arange(count)%2,
+            np.arange(count))
+    for _ in range(steps):
+        photons.step()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    memory['PhotonBatch'] = size/count
+    return memory
+
+
+def compare(baseline, current, tolerance=.1):
+    '''Scenarios of `current` whose photons per second fell more than
+    tolerance (a fraction) below `baseline`, by name, with the ratio
+    current/baseline
+    '''
+    slower = {}
+    for name, result in current['scenarios'].items():
+        old = baseline['scenarios'].get(name)
+        if old is None or old['propagation'] != result['propagation']:
+            continue
+        ratio = result['photons_per_second']/old['photons_per_second']
+        if ratio < 1-tolerance:
+            slower[name] = ratio
+    return slower
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('scenarios', nargs='*',
+            help="any of {}, all of them by default".format(
+                ", ".join(SCENARIOS)))
+    parser.add_argument('--propagation', default='event',
+            choices=['event', 'step', 'jit'])
+    parser.add_argument('--scale', type=float, default=1.,
+            help="multiply every scenario's photon count")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--bit-generator', default='PCG64',
+            choices=sorted(BIT_GENERATORS))
+    parser.add_argument('--output', help="write the results to this file")
+    parser.add_argument('--compare', metavar='BASELINE',
+            help="results file to check for regressions against")
+    parser.add_argument('--tolerance', type=float, default=.1)
+    parser.add_argument('--memory', type=int, metavar='PHOTONS', const=50000,
+            nargs='?', help="also measure bytes per live photon of each "
+            "photon model with this many in flight")
+    args = parser.parse_args(argv)
+    unknown = set(args.scenarios)-set(SCENARIOS)
+    if unknown:
+        parser.error("unknown scenarios: "+", ".join(sorted(unknown)))
+
+    results = run_benchmarks(args.scenarios, args.scale, args.propagation,
+            args.repeat, args.seed, args.bit_generator)
+    if args.memory:
+        results['bytes_per_photon'] = particle_memory(args.memory)
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+    for name, result in results['scenarios'].items():
+        print("{:<28}{:>12.0f} photons/s{:>9.0f} ns/interaction{:>9.1f} MB"
+                .format(name, result['photons_per_second'],
+                    result['ns_per_interaction'],
+                    result['peak_memory_bytes']/2**20), file=sys.stderr)
+    for name, size in results.get('bytes_per_photon', {}).items():
+        print("{:<28}{:>12.0f} bytes/photon".format(name, size),
+                file=sys.stderr)
+    if args.compare:
+        with open(args.compare) as f:
+            slower = compare(json.load(f), results, args.tolerance)
+        for name, ratio in slower.items():
+            print("{} is {:.0%} slower".format(name, 1-ratio),
+                    file=sys.stderr)
+        return 1 if slower else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
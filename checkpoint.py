@@ -0,0 +1,226 @@
+"""Snapshots of a running simulation that it can be resumed from.
+
+A checkpoint is one compressed .npz file: the photons still in flight,
+the layer stack and any spectrum as arrays, plus a JSON record of the
+counts, source, photon ids and random generator state. A resumed run
+draws the same random numbers in the same order, so it ends with exactly
+the counts the uninterrupted run would have had.
+
+For a batch job on machines that can disappear at any moment:
+
+    >>> from checkpoint import run_checkpointed
+    >>> run_checkpointed('run.ckpt.npz', 10**8,
+    ...         lambda: Simulation(buildLayers([1.33]), seed=1))
+
+picks the run up from run.ckpt.npz if it exists and saves it there every
+ten minutes. The GUI saves and loads checkpoints from its File menu.
+"""
+import json
+import os
+import time
+import numpy as np
+from stack import Layer, LayerStack
+from simulation import Simulation
+from spectral import SpectralHistogram
+
+#bump when the layout changes, older checkpoints are refused
+CHECKPOINT_VERSION = 2
+#stack.Layer attributes a checkpoint stores for every layer
+LAYER_COLUMNS = ('n', 'y0', 'yf', 'nprev', 'nnext', 'dndlambda')
+
+
+def _photon_arrays(photons):
+    #every slot with its free list, dead ones too, so a resumed run fills
+    #and steps through them, drawing its random numbers, in the same order
+    arrays = {'photon_'+name: getattr(photons, name)[:photons.size]
+            for name, _ in photons.FIELDS}
+    arrays['photon_free'] = photons._free[:photons.nfree]
+    return arrays
+
+
+def _restore_photons(photons, arrays):
+    count = len(arrays['photon_alive'])
+    free = arrays.get('photon_free', np.zeros(0, dtype=np.int64))
+    photons.clear()
+    photons._reserve(count)
+    for name, _ in photons.FIELDS:
+        getattr(photons, name)[:count] = arrays['photon_'+name]
+    photons._free[:len(free)] = free
+    photons.size = count
+    photons.nfree = len(free)
+
+
+def _stack_arrays(layers):
+    stack = layers if isinstance(layers, LayerStack) else LayerStack(layers)
+    return {'layer_'+name: getattr(stack, name) for name in LAYER_COLUMNS}
+
+
+def _layers(arrays, layer_class=Layer):
+    columns = [arrays['layer_'+name].tolist() for name in LAYER_COLUMNS]
+    return [layer_class(*row) for row in zip(*columns)]
+
+
+def _spectrum_arrays(spectrum):
+    if spectrum is None:
+        return {}
+    return {'spectrum_edges': spectrum.edges, 'spectrum_counts': spectrum.counts}
+
+
+def _spectrum(arrays):
+    if 'spectrum_counts' not in arrays:
+        return None
+    counts = arrays['spectrum_counts']
+    spectrum = SpectralHistogram(arrays['spectrum_edges'], counts.shape[1],
+            counts.dtype)
+    spectrum.counts[...] = counts
+    return spectrum
+
+
+def _json_default(value):
+    #Philox and some other bit generators keep their state in arrays
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.integer):
+        return int(value)
+    raise TypeError("{!r} is not JSON serializable".format(value))
+
+
+def _write(path, meta, arrays):
+    #write then rename, so being killed mid-save leaves the last checkpoint
+    tmp = path+'.tmp'
+    meta = dict(meta, version=CHECKPOINT_VERSION)
+    text = json.dumps(meta, default=_json_default)
+    with open(tmp, 'wb') as f:
+        np.savez_compressed(f, meta=np.frombuffer(text.encode(),
+            dtype=np.uint8), **arrays)
+    os.replace(tmp, path)
+
+
+def _read(path):
+    with np.load(path) as data:
+        arrays = {key: data[key] for key in data.files}
+    meta = json.loads(arrays.pop('meta').tobytes().decode())
+    if meta.get('version') != CHECKPOINT_VERSION:
+        raise ValueError("{} is not a version {} checkpoint".format(path,
+            CHECKPOINT_VERSION))
+    return meta, arrays
+
+
+def save_simulation(sim, path):
+    '''Checkpoint a simulation.Simulation. Its photon_log isn't part of the
+    checkpoint; reopen it in append mode after resuming. Subclasses, like
+    weighted.WeightedSimulation, keep state a checkpoint doesn't hold and
+    are refused rather than resumed as a plain Simulation.
+    '''
+    if type(sim) is not Simulation:
+        raise TypeError("can only checkpoint a Simulation, not a {}".format(
+            type(sim).__name__))
+    cache = sim.photons.reflectance_cache
+    meta = {
+        'kind': 'simulation',
+        'angle': sim.angle,
+        'wavelength_spec': sim.wavelength_spec,
+        'nbuckets': len(sim.reflection_counts),
+        'bounds': list(sim.photons.bounds),
+        'propagation': sim.propagation,
+        'first_id': sim.first_id,
+        'emitted': sim.emitted,
+        'reflectance_resolution': cache.resolution if cache else None,
+        'reflection_counts': sim.reflection_counts,
+        'rng': sim.rng.bit_generator.state,
+    }
+    arrays = _photon_arrays(sim.photons)
+    arrays.update(_stack_arrays(sim.stack))
+    arrays.update(_spectrum_arrays(sim.spectrum))
+    _write(path, meta, arrays)
+
+
+def load_simulation(path, photon_log=None):
+    '''The simulation.Simulation saved to `path` by save_simulation'''
+    meta, arrays = _read(path)
+    if meta['kind'] != 'simulation':
+        raise ValueError("{} is a {} checkpoint".format(path, meta['kind']))
+    sim = Simulation(_layers(arrays), meta['angle'], meta['wavelength_spec'],
+            None, meta['nbuckets'], tuple(meta['bounds']),
+            meta['propagation'], meta['first_id'],
+            meta['reflectance_resolution'], photon_log, _spectrum(arrays),
+            bit_generator=meta['rng']['bit_generator'])
+    sim.rng.bit_generator.state = meta['rng']
+    sim.emitted = meta['emitted']
+    sim.reflection_counts.update(meta['reflection_counts'])
+    _restore_photons(sim.photons, arrays)
+    return sim
+
+
+def run_checkpointed(path, n_photons, make_simulation, interval=600.,
+        batch_size=100000):
+    '''Simulation.run(n_photons, batch_size) that saves itself to `path`
+    every `interval` seconds and when done. If `path` already holds a
+    checkpoint the run carries on from there, otherwise it starts on
+    make_simulation(). Returns the simulation.
+    '''
+    if os.path.exists(path):
+        sim = load_simulation(path)
+    else:
+        sim = make_simulation()
+    last = time.monotonic()
+    while sim.emitted < n_photons or len(sim.photons):
+        if not len(sim.photons):
+            sim.emit(min(batch_size, n_photons-sim.emitted))
+        sim.step()
+        if time.monotonic()-last >= interval:
+            save_simulation(sim, path)
+            last = time.monotonic()
+    save_simulation(sim, path)
+    return sim
+
+
+def save_canvas(canvas, path):
+    '''Checkpoint the GUI's MyDynamicMplCanvas. Only the batch engine's
+    photons are saved, legacy Particles in flight are dropped.
+    '''
+    with canvas._lock:
+        state = canvas.rng.get_state()
+        meta = {
+            'kind': 'canvas',
+            'source': [canvas._source_x, canvas._source_y, canvas.theta],
+            'n0': canvas.n0,
+            'ids': canvas._ids,
+            'colormode': canvas.colormode,
+            'reflection_counts': canvas.reflection_counts,
+            'rng': state['generator'],
+        }
+        arrays = _photon_arrays(canvas.photons)
+        arrays.update(_stack_arrays(canvas.stack))
+        arrays.update(_spectrum_arrays(canvas.spectrum))
+        arrays['rng_block'] = np.array(state['block'])
+        _write(path, meta, arrays)
+
+
+def load_canvas(canvas, path, layer_class):
+    '''Restore a canvas checkpoint onto `canvas`, building its layers with
+    layer_class (artists.Layer)
+    '''
+    meta, arrays = _read(path)
+    if meta['kind'] != 'canvas':
+        raise ValueError("{} is a {} checkpoint".format(path, meta['kind']))
+    with canvas._lock:
+        canvas.reset()
+        canvas.setLayers(_layers(arrays, layer_class))
+        _restore_photons(canvas.photons, arrays)
+        canvas.reflection_counts.update(meta['reflection_counts'])
+        spectrum = _spectrum(arrays)
+        if spectrum is not None:
+            canvas.spectrum = spectrum
+        canvas._ids = meta['ids']
+        canvas.colormode = meta['colormode']
+        canvas.n0 = meta['n0']
+        x, y, canvas.theta = meta['source']
+        #set_source_angle ignores a paused canvas
+        paused, canvas.paused = canvas.paused, False
+        canvas.set_source_angle(x, y, canvas.theta)
+        canvas.paused = paused
+        canvas.setRandomGenerator(meta['rng']['bit_generator'])
+        canvas.rng.set_state({'generator': meta['rng'],
+            'block': arrays['rng_block'].tolist()})
+        canvas.update_photon_scatter()
@@ -0,0 +1,68 @@
+"""Binomial confidence intervals for reflection counts.
+
+Each bucket of a reflection_counts dict is a binomial count out of every
+photon tallied, so its fraction gets a Wilson score interval, which stays
+sensible for the nearly empty high-bounce buckets where the normal
+approximation collapses to zero width.
+"""
+import numpy as np
+
+#two-sided 95%
+Z95 = 1.96
+
+
+def wilson_interval(count, total, z=Z95):
+    '''Wilson score interval (low, high) of the fraction count/total;
+    array arguments give arrays
+    '''
+    count = np.asarray(count, dtype=float)
+    total = np.asarray(total, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p = count/total
+        denom = 1+z**2/total
+        center = (p+z**2/(2*total))/denom
+        half = z*np.sqrt(p*(1-p)/total+z**2/(4*total**2))/denom
+    empty = total == 0
+    return np.where(empty, 0., center-half), np.where(empty, 1., center+half)
+
+
+def count_intervals(reflection_counts, z=Z95):
+    '''Wilson interval of each bucket's fraction, keyed like
+    reflection_counts
+    '''
+    keys = list(reflection_counts)
+    counts = np.array([reflection_counts[key] for key in keys], dtype=float)
+    low, high = wilson_interval(counts, counts.sum(), z)
+    return {key: (float(low[i]), float(high[i])) for i, key in enumerate(keys)}
+
+
+def relative_errors(reflection_counts, z=Z95):
+    '''Half-width of each bucket's interval over its observed fraction,
+    inf for buckets nothing has landed in yet
+    '''
+    total = sum(reflection_counts.values())
+    errors = {}
+    for key, (low, high) in count_intervals(reflection_counts, z).items():
+        count = reflection_counts[key]
+        errors[key] = (high-low)/2/(count/total) if count else np.inf
+    return errors
+
+
+def converged(errors, epsilon, buckets=None):
+    '''Whether every bucket in `buckets` (all of them by default) of a
+    relative_errors dict is down to epsilon
+    '''
+    keys = errors if buckets is None else buckets
+    return all(errors[key] <= epsilon for key in keys)
+
+
+def photons_needed(errors, epsilon, tallied, buckets=None):
+    '''Estimate of how many photons in total bring the worst of `buckets`
+    down to epsilon, errors shrinking like 1/sqrt(photons); None while a
+    bucket is still empty
+    '''
+    keys = errors if buckets is None else buckets
+    worst = max(errors[key] for key in keys)
+    if not np.isfinite(worst):
+        return None
+    return int(np.ceil(tallied*(worst/epsilon)**2))
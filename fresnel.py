@@ -0,0 +1,220 @@
+"""Fresnel reflectance, evaluated exactly or read from cached tables.
+
+A ReflectanceCache trades a small, bounded interpolation error for not
+redoing the arcsin/cos/division work on every interface hit. Run this
+module to print its accuracy and speed against the exact path:
+
+    python fresnel.py
+"""
+import time
+import numpy as np
+from stack import LAMBDA0, WAVELENGTHS, as_stack, buildLayers, disperse
+
+
+def fresnel_reflectance(theta, new_sin, m, from_above, polarization):
+    '''Vectorized Particle.parallelPolarizedReflectivity and
+    Particle.perpendicularPolarizedReflectivity. Polarization 1 selects the
+    parallel component; total internal reflection gives 1.
+    '''
+    tir = np.abs(new_sin) > 1
+    theta_f = np.arcsin(np.where(tir, 0, new_sin))
+    cos_ti = np.cos(np.pi/2 - theta)
+    cos_ti = np.where(from_above, cos_ti, np.abs(cos_ti))
+    cos_tf = np.cos(theta_f)
+    rp = ((cos_tf-m*cos_ti)/(cos_ti+m*cos_tf))**2
+    rs = ((cos_ti-m*cos_tf)/(cos_tf+m*cos_ti))**2
+    r = np.where(polarization == 1, rp, rs)
+    return np.where(tir, 1., r)
+
+
+def exact_reflectance(stack, layer, from_above, polarization, wavelength,
+        theta):
+    '''Reflectance of photons with direction theta hitting `layer` of the
+    stack from above or below, evaluated exactly
+    '''
+    n, nprev, nnext = stack.ns_for_lambdas(layer, wavelength)
+    n_in = np.where(from_above, nprev, nnext)
+    new_sin = n_in*(np.sin(np.pi/2-theta))/n
+    return fresnel_reflectance(theta, new_sin, n/n_in, from_above,
+            polarization)
+
+
+class ReflectanceCache(object):
+    """R(θ) tables for each distinct interface of a stack, per polarization
+    and integer wavelength.
+
+    R only depends on the sine of the angle of incidence, u = |cos(theta)|
+    in the photons' convention. It is 1 past the critical angle u_max and
+    has a square-root edge just below it (or at grazing incidence), so each
+    table samples u = u_max*(1-(1-s)**2) on `resolution` even steps of s,
+    which straightens that edge out, and interpolates linearly in s.
+    Interfaces with the same indices on both sides share a table, and a
+    table is only filled the first time one of its wavelengths is hit.
+    Wavelengths off the integer grid are evaluated exactly.
+    """
+    def __init__(self, stack, resolution=512):
+        self.stack = as_stack(stack)
+        self.resolution = resolution
+        s = self.stack
+        #(n_in, n_out, dndlambda) for a hit on layer k from below (0) or above (1)
+        sides = np.stack([np.column_stack([s.nnext, s.n, s.dndlambda]),
+            np.column_stack([s.nprev, s.n, s.dndlambda])], axis=1)
+        self._pairs, inverse = np.unique(sides.reshape(-1, 3), axis=0,
+                return_inverse=True)
+        self.pair_index = inverse.reshape(len(s), 2)
+        self.invalidate()
+
+    def invalidate(self):
+        '''Forget every table, e.g. after editing the stack's layers in place'''
+        self._slots = np.full(len(self._pairs)*len(WAVELENGTHS), -1,
+                dtype=np.intp)
+        #row 2*slot+polarization holds one table
+        self._table = np.empty((0, self.resolution+1))
+        self._umax = np.empty(0)
+        self._rows = 0
+
+    def __len__(self):
+        '''Number of (interface, wavelength) pairs tabulated so far'''
+        return self._rows//2
+
+    def _fill(self, keys):
+        count = len(keys)
+        if self._rows+2*count > len(self._table):
+            grown = np.empty((max(2*len(self._table), self._rows+2*count),
+                self.resolution+1))
+            grown[:self._rows] = self._table[:self._rows]
+            self._table = grown
+            self._umax = np.resize(self._umax, len(grown)//2)
+        pair, col = np.divmod(keys, len(WAVELENGTHS))
+        n_in, n_out, dndlambda = self._pairs[pair].T
+        wavelength = WAVELENGTHS[col]
+        n_in = disperse(n_in, wavelength, dndlambda)[:, None]
+        n_out = disperse(n_out, wavelength, dndlambda)[:, None]
+        umax = np.minimum(1, n_out/n_in)
+        s = np.linspace(0, 1, self.resolution+1)
+        theta = np.arccos(umax*(1-(1-s)**2))
+        new_sin = n_in*(np.sin(np.pi/2-theta))/n_out
+        self._umax[self._rows//2:self._rows//2+count] = umax[:, 0]
+        rows = self._rows+2*np.arange(count)
+        for polarization in (0, 1):
+            self._table[rows+polarization] = fresnel_reflectance(theta,
+                    new_sin, n_out/n_in, True, polarization)
+        self._slots[keys] = np.arange(self._rows//2, self._rows//2+count)
+        self._rows += 2*count
+
+    def lookup(self, layer, from_above, polarization, wavelength, theta):
+        '''Interpolated reflectance, with the same arguments as
+        exact_reflectance
+        '''
+        layer = np.asarray(layer)
+        from_above = np.asarray(from_above, dtype=bool)
+        polarization = np.asarray(polarization)
+        wavelength = np.asarray(wavelength, dtype=float)
+        theta = np.asarray(theta, dtype=float)
+        col = wavelength-LAMBDA0
+        on_grid = (col == np.floor(col))&(col >= 0)&(col < len(WAVELENGTHS))
+        r = np.empty(len(theta))
+        if not on_grid.all():
+            off = ~on_grid
+            r[off] = exact_reflectance(self.stack, layer[off], from_above[off],
+                    polarization[off], wavelength[off], theta[off])
+            layer, from_above, polarization, col, theta = (layer[on_grid],
+                    from_above[on_grid], polarization[on_grid],
+                    col[on_grid], theta[on_grid])
+        keys = self.pair_index[layer, from_above.astype(np.intp)]*\
+                len(WAVELENGTHS)+col.astype(np.intp)
+        slots = self._slots[keys]
+        if (slots < 0).any():
+            self._fill(np.unique(keys[slots < 0]))
+            slots = self._slots[keys]
+        u = np.abs(np.cos(theta))/self._umax.take(slots)
+        pos = (1-np.sqrt(np.maximum(0, 1-u)))*self.resolution
+        i = np.minimum(pos.astype(np.intp), self.resolution-1)
+        frac = pos-i
+        #flat index into the table, row 2*slot+polarization
+        i += (2*slots+(polarization == 1))*(self.resolution+1)
+        lo = self._table.take(i)
+        hi = self._table.take(i+1)
+        r[on_grid] = np.where(u > 1, 1., lo+(hi-lo)*frac)
+        return r
+
+
+def reflectance_cache(stack, resolution=512):
+    '''The ReflectanceCache of a stack.LayerStack at `resolution`, built on
+    first use and then shared by everything using that stack
+    '''
+    caches = stack.reflectance_caches
+    if resolution not in caches:
+        caches[resolution] = ReflectanceCache(stack, resolution)
+    return caches[resolution]
+
+
+def _random_hits(stack, count, rng):
+    '''Random interface hits on every real interface of the stack: photons
+    going down (theta in (0, pi)) onto layers 1.., or up onto layers ..L-2
+    '''
+    from_above = rng.random(count) < .5
+    layer = np.where(from_above, rng.integers(1, len(stack), count),
+            rng.integers(0, len(stack)-1, count))
+    theta = rng.uniform(0, np.pi, count)
+    theta = np.where(from_above, theta, -theta)
+    polarization = rng.integers(0, 2, count)
+    wavelength = rng.integers(LAMBDA0, LAMBDA0+len(WAVELENGTHS), count)
+    return layer, from_above, polarization, wavelength.astype(float), theta
+
+
+def accuracy_report(stack, resolution=512, samples=200000, seed=0):
+    '''Error of the cached reflectance against the exact one over random
+    hits on the stack. Both are compared as reflection probabilities, i.e.
+    capped at 1, since that is all the Monte Carlo coin flip sees.
+    '''
+    stack = as_stack(stack)
+    hits = _random_hits(stack, samples, np.random.default_rng(seed))
+    exact = np.minimum(1, exact_reflectance(stack, *hits))
+    cached = np.minimum(1, ReflectanceCache(stack, resolution).lookup(*hits))
+    error = np.abs(cached-exact)
+    return {
+        'resolution': resolution,
+        'samples': samples,
+        'max_abs_error': float(error.max()),
+        'mean_abs_error': float(error.mean()),
+        'p99_abs_error': float(np.percentile(error, 99)),
+        'worst_theta': float(hits[-1][error.argmax()]),
+    }
+
+
+def benchmark(stack, resolution=512, hits=1000000, repeat=5, seed=0):
+    '''Nanoseconds per hit for exact and cached reflectance, best of
+    `repeat`, with the cache already warm
+    '''
+    stack = as_stack(stack)
+    args = _random_hits(stack, hits, np.random.default_rng(seed))
+    cache = ReflectanceCache(stack, resolution)
+    cache.lookup(*args)
+    def best(f):
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            f(*args)
+            times.append(time.perf_counter()-start)
+        return 1e9*min(times)/hits
+    exact_ns = best(lambda *a: exact_reflectance(stack, *a))
+    cached_ns = best(cache.lookup)
+    return {
+        'resolution': resolution,
+        'hits': hits,
+        'exact_ns_per_hit': exact_ns,
+        'cached_ns_per_hit': cached_ns,
+        'speedup': exact_ns/cached_ns,
+    }
+
+
+if __name__ == '__main__':
+    stack = as_stack(buildLayers([1.33, 1.6, 1.2]))
+    for resolution in (128, 512, 2048):
+        report = accuracy_report(stack, resolution)
+        report.update(benchmark(stack, resolution))
+        print(("resolution {resolution}: max error {max_abs_error:.2e}, "
+            "mean error {mean_abs_error:.2e}, exact {exact_ns_per_hit:.0f} "
+            "ns/hit, cached {cached_ns_per_hit:.0f} ns/hit "
+            "({speedup:.1f}x)").format(**report))
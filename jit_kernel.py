@@ -0,0 +1,241 @@
+"""Compiled scalar kernels for event propagation, with numba optional.
+
+PhotonBatch.advance() works on whole arrays, so every branch (reflect or
+refract, total internal reflection, crossing an outer face) costs a mask
+and a gather per event. next_events() and interact() instead loop over
+the photons one at a time, with the Fresnel coin flip and Snell's law
+inline, and numba compiles those loops to machine code in nopython mode.
+
+Simulation(..., propagation='jit') runs its photons through a JitBatch.
+Without numba installed, JitBatch.advance() falls back to the NumPy
+PhotonBatch.advance(), so the same code runs either way, only slower.
+
+A JitBatch goes through the same rounds as PhotonBatch.advance(), each
+photon to its next event per round, and draws one array of uniforms per
+round for the photons at an interface, in slot order. So a seed gives the
+same photons with the compiled kernels, their plain Python sources and
+the NumPy engine. Run as a script to check that.
+"""
+import math
+import numpy as np
+from stack import LAMBDA0, LAMBDAf
+from photon_batch import PhotonBatch
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+def _time_to_edge(pos, vel, low, high):
+    if vel > 0:
+        return (high-pos)/vel
+    if vel < 0:
+        return (low-pos)/vel
+    return math.inf
+
+
+def _disperse(n, wavelength, dndlambda):
+    #scalar stack.disperse
+    if n == 1:
+        return 1.
+    if dndlambda > 0:
+        return max(1., n+(wavelength-LAMBDA0)*dndlambda)
+    return max(1., n+(LAMBDAf-wavelength)*-dndlambda)
+
+
+def next_events_python(x, y, theta, vx, vy, wavelength, layer, live,
+        interfaces, n, nprev, nnext, dndlambda, ns_table, bounds, gone,
+        hits, hit_iface, hit_n_in, hit_n, hit_sin):
+    '''Move each photon in `live` to its next event, like the first half
+    of PhotonBatch.advance(): out through the edge of the bounds, freely
+    across an outer face of the stack, or to an inner interface. Packs the
+    photons still in flight into the front of live, those that left into
+    gone, and those at an interface into hits, all in slot order, with the
+    interface, the indices either side of it and the sine of Snell's law
+    for each hit. Returns how many are in each.
+    '''
+    xmin, xmax, ymin, ymax = bounds[0], bounds[1], bounds[2], bounds[3]
+    last = len(interfaces)-1
+    nwavelengths = ns_table.shape[2]
+    nlive = ngone = nhits = 0
+    for j in range(len(live)):
+        i = live[j]
+        down = vy[i] < 0
+        iface = layer[i]+1 if down else layer[i]
+        if vy[i] != 0 and 0 <= iface <= last:
+            t_iface = (interfaces[iface]-y[i])/vy[i]
+        else:
+            t_iface = math.inf
+        t_exit = min(_time_to_edge(x[i], vx[i], xmin, xmax),
+                _time_to_edge(y[i], vy[i], ymin, ymax))
+        if t_exit <= t_iface:
+            x[i] += vx[i]*t_exit
+            y[i] += vy[i]*t_exit
+            gone[ngone] = i
+            ngone += 1
+            continue
+        live[nlive] = i
+        nlive += 1
+        #only an interface between two layers of the stack refracts,
+        #the outer faces of the first and last layer are crossed freely
+        if not (iface < last if down else iface > 0):
+            x[i] += vx[i]*t_iface
+            y[i] = interfaces[iface]
+            layer[i] = iface if down else iface-1
+            continue
+        k = iface if down else iface-1
+        col = wavelength[i]-LAMBDA0
+        if col == math.floor(col) and 0 <= col < nwavelengths:
+            n_k = ns_table[0, k, int(col)]
+            n_prev = ns_table[1, k, int(col)]
+            n_next = ns_table[2, k, int(col)]
+        else:
+            n_k = _disperse(n[k], wavelength[i], dndlambda[k])
+            n_prev = _disperse(nprev[k], wavelength[i], dndlambda[k])
+            n_next = _disperse(nnext[k], wavelength[i], dndlambda[k])
+        n_in = n_prev if down else n_next
+        hits[nhits] = i
+        hit_iface[nhits] = iface
+        hit_n_in[nhits] = n_in
+        hit_n[nhits] = n_k
+        hit_sin[nhits] = n_in*(math.sin(math.pi/2-theta[i]))/n_k
+        nhits += 1
+    return nlive, ngone, nhits
+
+
+def interact_python(x, y, theta, v, vx, vy, polarization, bounces, layer,
+        hits, hit_iface, hit_n_in, hit_n, hit_sin, hit_asin, interfaces,
+        uniforms, counts):
+    '''Fresnel coin flip, with uniforms[j], for each of the hits found by
+    next_events, then reflect or refract it, like PhotonBatch._interact().
+    hit_asin is the arcsine of hit_sin, 0 where that is past 1. Adds the
+    interface hits, reflections and total internal reflections to counts.
+    '''
+    for j in range(len(hits)):
+        i = hits[j]
+        down = vy[i] < 0
+        n_in = hit_n_in[j]
+        n_k = hit_n[j]
+        new_sin = hit_sin[j]
+        #fresnel.fresnel_reflectance
+        if abs(new_sin) > 1:
+            r = 1.
+        else:
+            m = n_k/n_in
+            cos_ti = math.cos(math.pi/2-theta[i])
+            if not down:
+                cos_ti = abs(cos_ti)
+            cos_tf = math.cos(hit_asin[j])
+            if polarization[i] == 1:
+                r = (cos_tf-m*cos_ti)/(cos_ti+m*cos_tf)
+            else:
+                r = (cos_ti-m*cos_tf)/(cos_tf+m*cos_ti)
+            r = r*r
+        trapped = not (-1 < new_sin < 1)
+        reflect = uniforms[j] < r or trapped
+        counts[0] += 1
+        if reflect:
+            counts[1] += 1
+        if trapped:
+            counts[2] += 1
+        boundary = interfaces[hit_iface[j]]
+        pct_move = (boundary-y[i])/vy[i]
+        y[i] += vy[i]*pct_move
+        x[i] += vx[i]*pct_move
+        if reflect:
+            bounces[i] += 1
+            theta[i] = -theta[i]
+        else:
+            theta_f = math.pi/2-hit_asin[j]
+            theta[i] = theta_f if down else -theta_f
+            v[i] = v[i]*n_in/n_k
+            layer[i] = hit_iface[j] if down else hit_iface[j]-1
+        vx[i] = math.cos(theta[i])*v[i]
+        vy[i] = math.sin(theta[i])*v[i]
+        y[i] = boundary
+
+
+if numba is not None:
+    #the kernels can only call compiled functions, so from here on the
+    #Python sources call the compiled helpers too. cache=True keeps the
+    #machine code in __pycache__ for the next process, sparing every
+    #runner or sweep worker the compile
+    _time_to_edge = numba.njit(cache=True)(_time_to_edge)
+    _disperse = numba.njit(cache=True)(_disperse)
+    next_events = numba.njit(cache=True, nogil=True)(next_events_python)
+    interact = numba.njit(cache=True, nogil=True)(interact_python)
+else:
+    next_events = interact = None
+
+
+class JitBatch(PhotonBatch):
+    """A PhotonBatch whose advance() runs every photon to the edge of the
+    bounds, a round of events at a time, through the kernels next_events()
+    and interact(). The kernels evaluate reflectances exactly, ignoring any
+    reflectance_cache. With no kernels, as without numba, it is
+    PhotonBatch.advance().
+    """
+    def __init__(self, layers, capacity=256, bounds=(-1, 1, -1, 1),
+            rng=np.random, reflectance_cache=None, profiler=None,
+            kernels=(next_events, interact)):
+        PhotonBatch.__init__(self, layers, capacity, bounds, rng,
+                reflectance_cache, profiler)
+        self.kernels = kernels
+
+    def advance(self):
+        if self.kernels[0] is None:
+            return PhotonBatch.advance(self)
+        if not self.stack.contiguous:
+            raise ValueError("advance() needs contiguous layers")
+        next_events, interact = self.kernels
+        live = self.live()
+        stack = self.stack
+        bounds = np.asarray(self.bounds, dtype=float)
+        gone = np.empty(len(live), dtype=np.int64)
+        hits = np.empty(len(live), dtype=np.int64)
+        hit_iface = np.empty(len(live), dtype=np.int64)
+        hit_n_in = np.empty(len(live))
+        hit_n = np.empty(len(live))
+        hit_sin = np.empty(len(live))
+        counts = np.zeros(3, dtype=np.int64)
+        ngone = 0
+        while len(live):
+            nlive, left, nhits = next_events(self.x, self.y, self.theta,
+                    self.vx, self.vy, self.wavelength, self.layer, live,
+                    stack.interfaces, stack.n, stack.nprev, stack.nnext,
+                    stack.dndlambda, stack.ns_table, bounds, gone[ngone:],
+                    hits, hit_iface, hit_n_in, hit_n, hit_sin)
+            live = live[:nlive]
+            ngone += left
+            if not nhits:
+                continue
+            #PhotonBatch._interact's draw, for the same photons
+            uniforms = self.rng.random(nhits)
+            #NumPy's vectorized arcsin can be an ulp off libm's, so take
+            #it from NumPy as fresnel_reflectance and _refract do
+            new_sin = hit_sin[:nhits]
+            asin = np.arcsin(np.where(np.abs(new_sin) > 1, 0, new_sin))
+            interact(self.x, self.y, self.theta, self.v, self.vx, self.vy,
+                    self.polarization, self.bounces, self.layer,
+                    hits[:nhits], hit_iface[:nhits], hit_n_in[:nhits],
+                    hit_n[:nhits], new_sin, asin, stack.interfaces,
+                    uniforms, counts)
+        if self.profiler is not None:
+            self.profiler.count('interface_hits', int(counts[0]))
+            self.profiler.count('reflections', int(counts[1]))
+            self.profiler.count('total_internal_reflections', int(counts[2]))
+        gone = gone[:ngone]
+        self._release(gone)
+        return gone
+
+
+if __name__ == '__main__':
+    from stack import buildLayers
+    from simulation import simulate
+    for ns in ([1.33], [1.33, 1.6, 1.2], [2.3, 1.38]*20):
+        for angle in (30, 75, 120):
+            args = (buildLayers(ns), 20000, angle, 'broadband')
+            same = (simulate(*args, seed=3, propagation='jit') ==
+                    simulate(*args, seed=3, propagation='event'))
+            print("{} layers at {}°: 'jit' {} 'event'".format(len(ns), angle,
+                "matches" if same else "DIFFERS FROM"))
@@ -70,6 +70,18 @@ class RefractionMenuWidget(QtWidgets.QScrollArea):
         self.dndlambda_edit.setText("0.001")
         label2_l.addWidget(self.dndlambda_edit)
         menu_l.addLayout(label2_l)
+
+        #Periodic stacks: the list above is one period, "n, thickness" per row
+        label11_l = QtWidgets.QHBoxLayout()
+        label11_l.addWidget(QtWidgets.QLabel(self, text="Repeats = "))
+        self.repeats_edit = QtWidgets.QLineEdit(self)
+        self.repeats_edit.setText("1")
+        label11_l.addWidget(self.repeats_edit)
+        label11_l.addWidget(QtWidgets.QLabel(self, text="Chirp = "))
+        self.chirp_edit = QtWidgets.QLineEdit(self)
+        self.chirp_edit.setText("0")
+        label11_l.addWidget(self.chirp_edit)
+        menu_l.addLayout(label11_l)
         
         menu_l.addWidget(self.HLine())
 
@@ -133,6 +145,50 @@ class RefractionMenuWidget(QtWidgets.QScrollArea):
         colorBox.addWidget(broadbtn)
         menu_l.addWidget(colorWidget)
 
+        menu_l.addWidget(self.HLine())
+
+        #Simulation speed config
+        label8_l = QtWidgets.QHBoxLayout()
+        label8_l.addWidget(QtWidgets.QLabel("Simulation:"))
+        self.update_sim_btn = QtWidgets.QToolButton(text="Update")
+        label8_l.addWidget(self.update_sim_btn)
+        menu_l.addLayout(label8_l)
+
+        label9_l = QtWidgets.QHBoxLayout()
+        label9_l.addWidget(QtWidgets.QLabel(self,text="  Photons/tick = "))
+        self.emission_edit = QtWidgets.QLineEdit(self)
+        self.emission_edit.setText("1")
+        label9_l.addWidget(self.emission_edit)
+        menu_l.addLayout(label9_l)
+
+        label10_l = QtWidgets.QHBoxLayout()
+        label10_l.addWidget(QtWidgets.QLabel(self,text="  Ticks/frame = "))
+        self.substeps_edit = QtWidgets.QLineEdit(self)
+        self.substeps_edit.setText("1")
+        label10_l.addWidget(self.substeps_edit)
+        menu_l.addLayout(label10_l)
+
+        self.threaded_check = QtWidgets.QCheckBox("Run in background thread")
+        menu_l.addWidget(self.threaded_check)
+
+        #Pause once every count is known well enough, 0 runs forever
+        label12_l = QtWidgets.QHBoxLayout()
+        label12_l.addWidget(QtWidgets.QLabel(self,text="  Target error = "))
+        self.target_error_edit = QtWidgets.QLineEdit(self)
+        self.target_error_edit.setText("0")
+        label12_l.addWidget(self.target_error_edit)
+        menu_l.addLayout(label12_l)
+
+        label13_l = QtWidgets.QHBoxLayout()
+        label13_l.addWidget(QtWidgets.QLabel(self,text="  Photon budget = "))
+        self.budget_edit = QtWidgets.QLineEdit(self)
+        self.budget_edit.setText("0")
+        label13_l.addWidget(self.budget_edit)
+        menu_l.addLayout(label13_l)
+
+        self.convergence_label = QtWidgets.QLabel(self, text="")
+        menu_l.addWidget(self.convergence_label)
+
         menu_l.addStretch(1)
 
         self.radiobtns = {
@@ -155,7 +211,10 @@ class RefractionMenuWidget(QtWidgets.QScrollArea):
         def buildEvent():
             e = _Event()
             e.refraction_indices = self.get_layer_idxs()
+            e.thicknesses = self.get_layer_thicknesses()
             e.dndlambda = float(self.dndlambda_edit.text())
+            e.repeats = int(self.repeats_edit.text())
+            e.chirp = float(self.chirp_edit.text())
             return e
 
         self.updatebtn.clicked.connect(lambda:callback(buildEvent()))
@@ -171,6 +230,19 @@ class RefractionMenuWidget(QtWidgets.QScrollArea):
 
         self.update_auto_btn.clicked.connect(lambda:callback(buildEvent()))
 
+    def connectSimulationUpdate(self,callback):
+        class _Event: pass
+        def buildEvent():
+            e = _Event()
+            e.emission_rate = int(self.emission_edit.text())
+            e.substeps = int(self.substeps_edit.text())
+            e.threaded = self.threaded_check.isChecked()
+            e.target_error = float(self.target_error_edit.text())
+            e.photon_budget = int(self.budget_edit.text())
+            return e
+
+        self.update_sim_btn.clicked.connect(lambda:callback(buildEvent()))
+
     def connectSave(self,callback):
         self.savebtn.clicked.connect(callback)
 
@@ -198,15 +270,33 @@ class RefractionMenuWidget(QtWidgets.QScrollArea):
             idx = self.layer_list.indexFromItem(item)
             self.layer_list.takeItem(idx.row())
 
-    def setCountLabel(self,key,count,pct):
-        self.count_labels[key].setText(
-                "{}: {} ({}%)".format(key,count,pct))
+    def setCountLabel(self,key,count,pct,error=None):
+        if error is None:
+            self.count_labels[key].setText(
+                    "{}: {} ({}%)".format(key,count,pct))
+        else:
+            self.count_labels[key].setText(
+                    "{}: {} ({} ± {}%)".format(key,count,pct,error))
+
+    def setConvergenceText(self,text):
+        self.convergence_label.setText(text)
 
     def get_layer_idxs(self):
         layers =[]
         for i in range(self.layer_list.count()):
             item = self.layer_list.item(i)
-            layers.append(float(item.text()))
+            layers.append(float(item.text().split(",")[0]))
 
         return layers
 
+    def get_layer_thicknesses(self):
+        #rows are "n" or "n, thickness", None unless every row has one
+        thicknesses = []
+        for i in range(self.layer_list.count()):
+            fields = self.layer_list.item(i).text().split(",")
+            if len(fields) < 2:
+                return None
+            thicknesses.append(float(fields[1]))
+
+        return thicknesses
+
@@ -12,6 +12,7 @@ from __future__ import unicode_literals
 import sys
 import os
 import random
+import threading
 import numpy as np
 import matplotlib
 # Make sure that we are using QT5
@@ -21,10 +22,20 @@ from PyQt5 import QtCore, QtWidgets
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.figure import Figure
 from matplotlib.patches import Polygon, Rectangle
-from artists import Layer, buildLayers, Particle,LAMBDA0,LAMBDAf
+from artists import (Layer, buildLayers, Particle, ParticlePool, LAMBDA0,
+        LAMBDAf, wavelengths_to_rgb)
+from photon_batch import PhotonBatch, tally_bounces
 from menu_items import RefractionMenuWidget
+from stack import VACCUM_SPEED, LayerStack, periodic
+from fresnel import reflectance_cache
+from photon_log import PhotonLogWriter, exit_sides
+from spectral import SpectralHistogram
+from result_cache import ResultCache, config_key
+from confidence import converged, count_intervals, relative_errors
+from checkpoint import save_canvas, load_canvas
+from profiling import Profiler, timed
+from random_buffer import RandomBuffer
 
-VACCUM_SPEED = 0.04
 progname = os.path.basename(sys.argv[0])
 progversion = "0.1"
 
@@ -65,10 +76,42 @@ class MyDynamicMplCanvas(MyMplCanvas):
         timer.timeout.connect(self.update_figure)
         timer.start(32)
         self._ids = 0
-        self._to_delete = set()
-        self.moving_artists = {}
-        self._cleanup = 20 #only check for cleanup every 1/n frames
-        self._frame = 0
+        #Particles in flight, and those that left since the last tally
+        self.moving_artists = ParticlePool()
+        self._departed = []
+        #'batch' steps every photon at once through a PhotonBatch, 'particle'
+        #keeps the original one-Particle-per-photon model
+        self.engine = 'batch'
+        #classes of the Particles and Layers made from now on, e.g.
+        #artists.SlottedParticle and SlottedLayer to save memory
+        self.particle_class = Particle
+        self.layer_class = Layer
+        self.photons = None
+        #every random number of the simulation, drawn a block at a time
+        self.rng = RandomBuffer()
+        #interpolate reflectances from fresnel.ReflectanceCache tables of this
+        #resolution instead of evaluating them, None for exact
+        self.reflectance_resolution = None
+        #only redraw the moving artists over a cached background each frame
+        self.use_blit = True
+        self._background = None
+        #one collection draws every photon in the batch
+        self._photon_scatter = self.axes.scatter([],[],s=36,
+                edgecolors='face',animated=self.use_blit)
+        #simulation ticks run per frame, each emitting emission_rate photons
+        #at the source, or continuously on a SimulationWorker thread
+        self.substeps = 1
+        self.emission_rate = 1
+        self._lock = threading.RLock()
+        self._worker = None
+        #a photon_log.PhotonLogWriter recording every photon that leaves
+        self.photon_log = None
+        #exiting photons by wavelength, bounces and side
+        self.spectrum = SpectralHistogram()
+        #a profiling.Profiler timing each part of a frame, with an overlay
+        #of its rates, while profiling is on
+        self.profiler = None
+        self._profile_text = None
         self.isclicked = False
         self.n0 = 1
         self.last_x = 1
@@ -102,9 +145,53 @@ class MyDynamicMplCanvas(MyMplCanvas):
         self.mpl_connect('button_press_event',onclick)
         self.mpl_connect('button_release_event',onmouseup)
         self.mpl_connect('motion_notify_event',onmove)
+        self.mpl_connect('draw_event',self._on_draw)
 
     def save(self,fname='fig.png'):
+        #savefig leaves animated artists out, so include them for the file
+        artists = self._animated_artists()
+        for artist in artists:
+            artist.set_animated(False)
         self.fig.savefig(fname)
+        for artist in artists:
+            artist.set_animated(self.use_blit)
+        self.draw()
+
+    def _animated_artists(self):
+        artists = [self._photon_scatter]
+        artists.extend(particle._artist for particle in
+                self.moving_artists)
+        if getattr(self,'_source_box',None) is not None:
+            artists.append(self._source_box)
+        if self._profile_text is not None:
+            artists.append(self._profile_text)
+        return artists
+
+    def _draw_animated(self):
+        for artist in self._animated_artists():
+            self.axes.draw_artist(artist)
+
+    def _on_draw(self,event):
+        #a full redraw (startup, resize, new layers) skips the animated
+        #artists, so keep it as the background and paint them over it
+        if self.use_blit:
+            self._background = self.copy_from_bbox(self.fig.bbox)
+            self._draw_animated()
+
+    def render(self):
+        if not self.use_blit or self._background is None:
+            self.draw()
+        else:
+            self.restore_region(self._background)
+            self._draw_animated()
+            self.blit(self.fig.bbox)
+
+    def setBlitting(self,use_blit):
+        self.use_blit = use_blit
+        self._background = None
+        for artist in self._animated_artists():
+            artist.set_animated(use_blit)
+        self.draw()
 
     def pause(self):
         self.paused = True
@@ -156,6 +243,14 @@ class MyDynamicMplCanvas(MyMplCanvas):
         self.layers = layers
         for layer in layers:
             layer.set_master(self)
+        #index tables are per stack, so rebuild them with every new stack
+        self.stack = LayerStack(layers)
+        cache = None
+        if self.reflectance_resolution:
+            cache = reflectance_cache(self.stack, self.reflectance_resolution)
+        with self._lock:
+            self.photons = PhotonBatch(self.stack, rng=self.rng,
+                    reflectance_cache=cache, profiler=self.profiler)
 
         self.draw()
 
@@ -202,7 +297,7 @@ class MyDynamicMplCanvas(MyMplCanvas):
         ys = [y1,y2,y3,y4]
 
         self._source_box = Polygon(np.column_stack([xs,ys]),fill=True,
-                facecolor=(.5,.5,.5))
+                facecolor=(.5,.5,.5),animated=self.use_blit)
         self.axes.add_artist(self._source_box)
         self.master.update_angle(int(np.rad2deg(np.pi/2 - self.theta)))
 
@@ -210,10 +305,9 @@ class MyDynamicMplCanvas(MyMplCanvas):
     def free_move_source(self,x,y):
         if self.paused: return
         self.set_source_angle(x,y,self.theta)
-        for layer in self.layers:
-            if layer.contains(y):
-                self.n0 = layer.n
-                break
+        layer = self.stack.layer_at(y)
+        if layer is not None:
+            self.n0 = layer.n
 
     def rotate_source(self,theta):
         self.theta=theta
@@ -232,19 +326,22 @@ class MyDynamicMplCanvas(MyMplCanvas):
         if event_y < 0:
             self.theta = -self.theta
             y = -y
-            for layer in self.layers:
-                if layer.contains(y):
-                    self.n0 = layer.n
-                    break
+            layer = self.stack.layer_at(y)
+            if layer is not None:
+                self.n0 = layer.n
         self.set_source_angle(x,y,theta,True)
         #self.draw()
 
 
     def reset(self):
         for particle in self.moving_artists:
-            self.moving_artists[particle]._delete_self()
+            particle._delete_self()
 
         self._remove_particles()
+        if self.photons is not None:
+            with self._lock:
+                self.photons.clear()
+                self.update_photon_scatter()
 
         for layer in self.layers:
             layer.remove()
@@ -257,46 +354,184 @@ class MyDynamicMplCanvas(MyMplCanvas):
 
     def update_figure(self):
         if self.paused: return
-        # Build a list of 4 random integers between 0 and 10 (both inclusive)
-        self._frame+=1
-        for key in self.moving_artists:
-            self.moving_artists[key].update()
-        if self._frame%self._cleanup == 0:
-            self._remove_particles()
+        if self._worker is None:
+            for _ in range(self.substeps):
+                self.tick()
 
         if self.isrotating:
-            self.framesrotating += 1
-            speed = (self.framesrotating*np.pi/360 if self.framesrotating < 24 
-                    else np.pi/15)
-            self.rotate_source((self.theta+self.isrotating*speed)%(2*np.pi))
+            with timed(self.profiler,'rotation'):
+                self.framesrotating += 1
+                speed = (self.framesrotating*np.pi/360
+                        if self.framesrotating < 24 else np.pi/15)
+                self.rotate_source(
+                        (self.theta+self.isrotating*speed)%(2*np.pi))
+        with timed(self.profiler,'draw'):
+            with self._lock:
+                if self.photons is not None:
+                    self.update_photon_scatter()
+                if self.profiler is not None:
+                    self.profiler.frame()
+                    self.update_profile_text()
+            self.render()
+
+    def tick(self):
+        """Emit emission_rate photons at the source and advance everything
+        one simulation step"""
+        with self._lock:
+            with timed(self.profiler,'step'):
+                self.emit_at_source(self.emission_rate,VACCUM_SPEED)
+                for particle in self.moving_artists:
+                    particle.update()
+                if self.photons is not None:
+                    self.update_photons()
+            if self._departed:
+                with timed(self.profiler,'removals'):
+                    self._remove_particles()
+
+    def setProfiling(self,enabled):
+        """Start timing and counting the hot paths, with an overlay of the
+        frame rate and photon throughput, or stop"""
+        with self._lock:
+            if enabled and self.profiler is None:
+                self.profiler = Profiler()
+                self._profile_text = self.axes.text(.02,.98,'',
+                        transform=self.axes.transAxes,va='top',
+                        family='monospace',animated=self.use_blit,
+                        bbox=dict(facecolor='white',alpha=.7))
+            elif not enabled and self.profiler is not None:
+                self.profiler = None
+                self._profile_text.remove()
+                self._profile_text = None
+            if self.photons is not None:
+                self.photons.profiler = self.profiler
         self.draw()
 
-
-    def remove_particle(self,id_):
-        self._to_delete.add(id_)
+    def setRandomGenerator(self,bit_generator='PCG64',seed=None):
+        """Draw from a new random_buffer.RandomBuffer on the named bit
+        generator, e.g. 'Philox', seeded to replay a session"""
+        with self._lock:
+            self.rng = RandomBuffer(seed,bit_generator)
+            if self.photons is not None:
+                self.photons.rng = self.rng
+
+    def update_profile_text(self):
+        rates = self.profiler.rates()
+        live = len(self.moving_artists)
+        if self.photons is not None:
+            live += len(self.photons)
+        self._profile_text.set_text(
+                "FPS {:.1f}\nlive {}\nphotons/s {:.0f}".format(
+                    rates.get('frames',0),live,rates.get('exited',0)))
+
+    def set_photon_log(self,photon_log):
+        with self._lock:
+            if self.photon_log is not None:
+                self.photon_log.close()
+            self.photon_log = photon_log
+
+    def setThreaded(self,threaded):
+        """Run ticks as fast as possible on a background thread instead of
+        substeps per frame. Only the batch engine can run threaded, the
+        Particle model moves its own artists."""
+        threaded = threaded and self.engine == 'batch'
+        if threaded and self._worker is None:
+            self._worker = SimulationWorker(self)
+            self._worker.start()
+        elif not threaded and self._worker is not None:
+            self._worker.stop()
+            self._worker = None
+
+    def update_photons(self):
+        gone = self.photons.step()
+        if self.profiler is not None:
+            self.profiler.count('exited',len(gone))
+        tally_bounces(self.reflection_counts, self.photons.bounces[gone])
+        self.spectrum.add_photons(self.photons, gone)
+        if self.photon_log is not None:
+            self.photon_log.write(self.photons, gone)
+
+    def update_photon_scatter(self):
+        live = self.photons.live()
+        self._photon_scatter.set_offsets(np.column_stack(
+            [self.photons.x[live],self.photons.y[live]]))
+        self._photon_scatter.set_facecolor(
+                wavelengths_to_rgb(self.photons.wavelength[live]))
+
+    def remove_particle(self,particle):
+        self.moving_artists.remove(particle)
+        self._departed.append(particle)
 
     def _remove_particles(self):
-        for key in self._to_delete:
-            particle = self.moving_artists.pop(key)
-            if particle.bounces >= len(self.reflection_counts)-1:
-                key = str(len(self.reflection_counts)-1)+"+"
-            else:
-                key = str(particle.bounces)
-            self.reflection_counts[key]+=1
-        self._to_delete = set()
+        """Tally the Particles that left since the last call"""
+        departed,self._departed = self._departed,[]
+        if self.profiler is not None:
+            self.profiler.count('exited',len(departed))
+        bounces = [particle.bounces for particle in departed]
+        tally_bounces(self.reflection_counts,bounces)
+        launched_down = np.array([particle.launched_down
+            for particle in departed])
+        vy = np.array([particle.vy for particle in departed])
+        wavelengths = [particle.wavelength for particle in departed]
+        self.spectrum.add(wavelengths,bounces,exit_sides(launched_down,vy))
+        if self.photon_log is not None and departed:
+            self.photon_log.write_arrays(
+                    [particle._id for particle in departed],wavelengths,
+                    [particle.polarization for particle in departed],bounces,
+                    [particle.x for particle in departed],
+                    [particle.y for particle in departed],
+                    [particle.vx for particle in departed],vy,launched_down)
 
     def add_particle(self,x=0,y=0,theta=0,v=0):
         if self.colormode == 'broadband':
-            wavelength = np.random.randint(LAMBDA0,LAMBDAf)
+            wavelength = self.rng.integers(LAMBDA0,LAMBDAf)
         else:
             wavelength = 670
-        self.moving_artists[self._ids] = (Particle(self,self._ids,x,y,theta,v,
-            polarization=self._ids%2, wavelength=wavelength))
+        if self.engine == 'batch':
+            self.photons.emit(x,y,theta,v,wavelength,self._ids%2,self._ids)
+        else:
+            particle = self.particle_class(self,self._ids,x,y,theta,v,
+                    polarization=self._ids%2,wavelength=wavelength)
+            particle._artist.set_animated(self.use_blit)
+            self.moving_artists.add(particle)
         self._ids += 1
 
     def add_particle_at_source(self,v=0):
         self.add_particle(self._source_x,self._source_y,self.theta,-v/self.n0)
 
+    def emit_at_source(self,count,v=0):
+        if self.engine != 'batch':
+            for _ in range(count):
+                self.add_particle_at_source(v)
+            return
+        ids = np.arange(self._ids,self._ids+count)
+        if self.colormode == 'broadband':
+            wavelength = self.rng.integers(LAMBDA0,LAMBDAf,count)
+        else:
+            wavelength = 670
+        self.photons.emit(self._source_x,self._source_y,self.theta,-v/self.n0,
+                wavelength,ids%2,ids)
+        self._ids += count
+
+
+class SimulationWorker(threading.Thread):
+    """Ticks a canvas's simulation as fast as it can, leaving the canvas's
+    frame timer to only sample and draw it"""
+    def __init__(self,canvas):
+        threading.Thread.__init__(self,daemon=True)
+        self.canvas = canvas
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            if self.canvas.paused:
+                self._stop_event.wait(.032)
+            else:
+                self.canvas.tick()
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
 
 class ApplicationWindow(QtWidgets.QMainWindow):
     def __init__(self):
@@ -305,6 +540,18 @@ class ApplicationWindow(QtWidgets.QMainWindow):
         self.setWindowTitle("Monte Carlo Refraction")
 
         self.file_menu = QtWidgets.QMenu('&File', self)
+        self.file_menu.addAction('&Log Photons...', self.start_photon_log)
+        self.file_menu.addAction('&Stop Logging', self.stop_photon_log)
+        self.file_menu.addAction('Show S&pectrum', self.show_spectrum)
+        self.file_menu.addAction('&Export Spectrum...', self.export_spectrum)
+        self.file_menu.addAction('Cache &Results in Folder...',
+                self.set_result_cache_folder)
+        self.file_menu.addAction('Save &Checkpoint...', self.save_checkpoint)
+        self.file_menu.addAction('L&oad Checkpoint...', self.load_checkpoint)
+        profile = self.file_menu.addAction('Pro&file')
+        profile.setCheckable(True)
+        profile.toggled.connect(self.set_profiling)
+        self.file_menu.addAction('Export Pro&file...', self.export_profile)
         self.file_menu.addAction('&Quit', self.fileQuit,
                                  QtCore.Qt.CTRL + QtCore.Qt.Key_Q)
         self.menuBar().addMenu(self.file_menu)
@@ -316,6 +563,10 @@ class ApplicationWindow(QtWidgets.QMainWindow):
                 "3":0,
                 "4+":0
         }
+        self.target_error = 0
+        self.photon_budget = 0
+        #counts of the stacks run so far, see update_layers
+        self.result_cache = ResultCache()
         self.automove = None
         self.automove_step = np.deg2rad(45)/30
         self.automove_bounds = (0,2*np.pi)
@@ -335,7 +586,7 @@ class ApplicationWindow(QtWidgets.QMainWindow):
         self.setCentralWidget(self.main_widget)
 
         timer = QtCore.QTimer(self)
-        timer.timeout.connect(self.create_particle)
+        timer.timeout.connect(self.automove_source)
         timer.start(32)
 
         timer2 = QtCore.QTimer(self)
@@ -351,6 +602,62 @@ class ApplicationWindow(QtWidgets.QMainWindow):
             self.dc.save(fname)
 
 
+    def start_photon_log(self):
+        fname, _ = QtWidgets.QFileDialog.getSaveFileName(self,
+                "Log Photons","","Photon Log (*.mcrlog)")
+        if fname:
+            self.dc.set_photon_log(PhotonLogWriter(fname))
+
+    def stop_photon_log(self):
+        self.dc.set_photon_log(None)
+
+    def show_spectrum(self):
+        dialog = QtWidgets.QDialog(self)
+        dialog.setWindowTitle("Spectrum")
+        canvas = FigureCanvas(Figure(figsize=(6,4),dpi=100))
+        with self.dc._lock:
+            self.dc.spectrum.plot(canvas.figure.add_subplot(111))
+        QtWidgets.QVBoxLayout(dialog).addWidget(canvas)
+        dialog.show()
+
+    def export_spectrum(self):
+        fname, _ = QtWidgets.QFileDialog.getSaveFileName(self,
+                "Export Spectrum","","CSV (*.csv);;NumPy (*.npz)")
+        if not fname:
+            return
+        with self.dc._lock:
+            if fname.endswith('.npz'):
+                self.dc.spectrum.save(fname)
+            else:
+                self.dc.spectrum.to_csv(fname)
+
+    def save_checkpoint(self):
+        fname, _ = QtWidgets.QFileDialog.getSaveFileName(self,
+                "Save Checkpoint","","Checkpoint (*.npz)")
+        if fname:
+            save_canvas(self.dc, fname)
+
+    def load_checkpoint(self):
+        fname, _ = QtWidgets.QFileDialog.getOpenFileName(self,
+                "Load Checkpoint","","Checkpoint (*.npz)")
+        if fname:
+            load_canvas(self.dc, fname, self.dc.layer_class)
+            self.dc.draw()
+
+    def set_profiling(self, enabled):
+        self.dc.setProfiling(enabled)
+
+    def export_profile(self):
+        if self.dc.profiler is None:
+            QtWidgets.QMessageBox.information(self, "Export Profile",
+                    "Turn on File > Profile first.")
+            return
+        fname, _ = QtWidgets.QFileDialog.getSaveFileName(self,
+                "Export Profile","","JSON (*.json)")
+        if fname:
+            with self.dc._lock:
+                self.dc.profiler.save(fname)
+
     def setup_canvas(self):
         l = QtWidgets.QHBoxLayout(self.main_widget)
         self.dc = MyDynamicMplCanvas(self.main_widget, dpi=100)
@@ -359,7 +666,7 @@ class ApplicationWindow(QtWidgets.QMainWindow):
 
         l.addWidget(self.dc)
 
-        layers = buildLayers([1.33])
+        layers = buildLayers([1.33],layer_class=self.dc.layer_class)
         self.dc.setLayers(layers)
 
         self.setup_menu(l)
@@ -378,6 +685,7 @@ class ApplicationWindow(QtWidgets.QMainWindow):
         self.menu_widget.connectButton('broad',self.set_colormode)
         self.menu_widget.connectLayersUpdate(self.update_layers)
         self.menu_widget.connectAutoMoveUpdate(self.update_automove)
+        self.menu_widget.connectSimulationUpdate(self.update_simulation)
         self.menu_widget.connectPause(self.dc.pause)
         self.menu_widget.connectUnpause(self.dc.unpause)
         self.menu_widget.connectSave(self.save_fig)
@@ -405,17 +713,57 @@ class ApplicationWindow(QtWidgets.QMainWindow):
 
     def update_layers(self,event):
         layers = event.refraction_indices
+        thicknesses = event.thicknesses
         dndlambda = event.dndlambda
-        self.dc.reset()
-        layers = buildLayers(layers,dndlambda)
-        self.dc.setLayers(layers)
-        #keeps the source in place, just redraw it
-        self.dc.rotate_source(self.dc.theta)
-        for key in self.reflection_counts:
-            self.reflection_counts[key] = 0
+        if event.repeats > 1 or event.chirp:
+            if thicknesses is None:
+                thicknesses = [1]*len(layers)
+            layers,thicknesses = periodic(zip(layers,thicknesses),
+                    event.repeats,event.chirp)
+        with self.dc._lock:
+            self.save_results()
+            self.dc.reset()
+            layers = buildLayers(layers,dndlambda,thicknesses,
+                    self.dc.layer_class)
+            self.dc.setLayers(layers)
+            #keeps the source in place, just redraw it
+            self.dc.rotate_source(self.dc.theta)
+            for key in self.reflection_counts:
+                self.reflection_counts[key] = 0
+            self.dc.spectrum.clear()
+            self.restore_results()
 
         self.dc.draw()
 
+    def results_key(self):
+        #the GUI has no seed, its rng carries on from wherever it is
+        angle = np.rad2deg(np.pi/2-self.dc.theta)
+        return config_key(self.dc.layers,angle,self.dc.colormode,None,
+                engine=self.dc.engine,nbuckets=len(self.reflection_counts))
+
+    def save_results(self):
+        photons = sum(self.reflection_counts.values())
+        if photons and self.dc.layers:
+            self.result_cache.put(self.results_key(),{'photons':photons,
+                'counts':dict(self.reflection_counts),
+                'spectrum':self.dc.spectrum.counts.tolist()})
+
+    def restore_results(self):
+        """Pick up the counts of the new stack where they were left"""
+        entry = self.result_cache.get(self.results_key())
+        if entry is not None:
+            self.reflection_counts.update(entry['counts'])
+            self.dc.spectrum.counts[...] = entry['spectrum']
+
+    def set_result_cache_folder(self):
+        folder = QtWidgets.QFileDialog.getExistingDirectory(self,
+                "Cache Results in Folder")
+        if folder:
+            cache = ResultCache(directory=folder)
+            for key in self.result_cache.keys():
+                cache.put(key,self.result_cache.get(key))
+            self.result_cache = cache
+
     def update_automove(self,event):
         twopi = 2*np.pi
         self.automove_step = np.deg2rad(event.angular_velocity)/30
@@ -428,6 +776,14 @@ class ApplicationWindow(QtWidgets.QMainWindow):
             cos_t = np.cos(self.automove_bounds[1])
             self.dc.move_source(cos_t,sin_t)
 
+    def update_simulation(self,event):
+        self.dc.emission_rate = max(1,event.emission_rate)
+        self.dc.substeps = max(1,event.substeps)
+        self.dc.setThreaded(event.threaded)
+        self.target_error = max(0,event.target_error)
+        self.photon_budget = max(0,event.photon_budget)
+        self.menu_widget.setConvergenceText("")
+
     def set_colormode(self,btn):
         if btn.isChecked():
             text = btn.text()
@@ -444,12 +800,37 @@ class ApplicationWindow(QtWidgets.QMainWindow):
         sum_ = 0.
         for key in self.reflection_counts:
             sum_ += self.reflection_counts[key]
-        if sum_ == 0: sum_ = 1
+        if sum_ == 0:
+            for key in self.reflection_counts:
+                self.menu_widget.setCountLabel(key,0,"0.00")
+            return
 
+        intervals = count_intervals(self.reflection_counts)
         for key in self.reflection_counts:
             count = self.reflection_counts[key]
             pct = "%.2f"%(100.*count/sum_)
-            self.menu_widget.setCountLabel(key,count,pct)
+            low,high = intervals[key]
+            error = "%.2f"%(100.*(high-low)/2)
+            self.menu_widget.setCountLabel(key,count,pct,error)
+        self.check_convergence(int(sum_))
+
+    def check_convergence(self,total):
+        #pause the run once it has converged or spent its budget
+        if not (self.target_error or self.photon_budget) or self.dc.paused:
+            return
+        errors = relative_errors(self.reflection_counts)
+        if self.target_error and converged(errors,self.target_error):
+            self.menu_widget.setConvergenceText(
+                    "Converged after {} photons".format(total))
+            self.dc.pause()
+        elif self.photon_budget and total >= self.photon_budget:
+            worst = max(errors.values())
+            if np.isfinite(worst):
+                text = "Budget spent, worst error {:.1%}".format(worst)
+            else:
+                text = "Budget spent, some counts still 0"
+            self.menu_widget.setConvergenceText(text)
+            self.dc.pause()
 
     def spin_source_full_circle(self):
         if self.automove == 'spin':
@@ -484,16 +865,17 @@ class ApplicationWindow(QtWidgets.QMainWindow):
             self.dc.move_source(sin_t,cos_t)
         
 
-    def create_particle(self):
+    def automove_source(self):
         if self.dc.paused: return
         twopi = 2*np.pi
-        self.dc.add_particle_at_source(VACCUM_SPEED)
         if(self.automove_bounds[0]%twopi== self.automove_bounds[1]%twopi):
             self.spin_source_full_circle()
         else:
             self.spin_source_between_bounds()
 
     def fileQuit(self):
+        self.dc.setThreaded(False)
+        self.dc.set_photon_log(None)
         self.close()
 
     def closeEvent(self, ce):
@@ -515,9 +897,10 @@ between qt4 and qt5"""
                                 )
 
 
-qApp = QtWidgets.QApplication(sys.argv)
+if __name__ == '__main__':
+    qApp = QtWidgets.QApplication(sys.argv)
 
-aw = ApplicationWindow()
-aw.setWindowTitle("%s" % progname)
-aw.show()
-sys.exit(qApp.exec_())
+    aw = ApplicationWindow()
+    aw.setWindowTitle("%s" % progname)
+    aw.show()
+    sys.exit(qApp.exec_())
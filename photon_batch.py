@@ -0,0 +1,327 @@
+"""Vectorized photon engine.
+
+A PhotonBatch keeps every photon in flight in parallel numpy arrays
+(struct-of-arrays) and advances all of them with one call to step(),
+applying the same Snell/Fresnel rules as artists.Particle.
+"""
+import numpy as np
+from stack import as_stack
+from fresnel import fresnel_reflectance
+
+
+def bucket_key(bounces, nbuckets):
+    if bounces >= nbuckets-1:
+        return str(nbuckets-1)+"+"
+    return str(bounces)
+
+
+def tally_bounces(reflection_counts, bounces, weights=None):
+    '''Add an array of bounce counts to a reflection_counts style dict, the
+    last bucket collecting everything at or above its value. With weights,
+    each photon adds its weight instead of 1.
+    '''
+    nbuckets = len(reflection_counts)
+    bounces = np.minimum(np.asarray(bounces, dtype=np.int64), nbuckets-1)
+    binned = np.bincount(bounces, weights, minlength=nbuckets)
+    for i, count in enumerate(binned):
+        count = int(count) if weights is None else float(count)
+        reflection_counts[bucket_key(i, nbuckets)] += count
+    return reflection_counts
+
+
+class PhotonBatch(object):
+    """All photons in flight through one layer stack.
+
+    Slots [0, size) of each array hold photons. Dead ones are flagged in
+    `alive` and their slots go on a free list that new photons are given
+    first, so a long-running batch recycles its slots instead of growing or
+    shuffling its arrays; capacity only doubles once every slot is in use.
+    Once no photon is left the slots start over from 0, so photons emitted
+    together into an empty batch keep their emission order. `layers` may be
+    a list of layers or a prebuilt stack.LayerStack.
+
+    Photons move either by fixed ticks with step(), as the GUI animates
+    them, or from one interface straight to the next with advance(). The
+    `layer` array tracks the medium each photon is in for advance(): an
+    index into `layers`, -1 above the stack or len(layers) below it. On
+    contiguous stacks step() keeps it up to date too, so each photon only
+    checks the interface it's heading for.
+
+    Reflectances are evaluated exactly unless a fresnel.ReflectanceCache is
+    given, which interpolates them from precomputed tables instead. A
+    profiling.Profiler counts interface hits, reflections and total
+    internal reflections.
+    """
+
+    FIELDS = (
+        ('ids', np.int64),
+        ('x', np.float64),
+        ('y', np.float64),
+        ('theta', np.float64),
+        ('v', np.float64),
+        ('vx', np.float64),
+        ('vy', np.float64),
+        ('wavelength', np.float64),
+        ('polarization', np.int8),
+        ('bounces', np.int32),
+        ('layer', np.int64),
+        ('launched_down', np.bool_),
+        ('alive', np.bool_),
+    )
+
+    def __init__(self, layers, capacity=256, bounds=(-1, 1, -1, 1),
+            rng=np.random, reflectance_cache=None, profiler=None):
+        self.stack = as_stack(layers)
+        self.bounds = bounds
+        self.rng = rng
+        self.reflectance_cache = reflectance_cache
+        self.profiler = profiler
+        self.size = 0
+        self.capacity = 0
+        #dead slots below size, a stack of the first nfree entries of _free
+        self.nfree = 0
+        self._free = np.zeros(0, dtype=np.int64)
+        self._grow(capacity)
+
+    def __len__(self):
+        return self.size-self.nfree
+
+    def _grow(self, capacity):
+        for name, dtype in self.FIELDS:
+            arr = np.zeros(capacity, dtype=dtype)
+            if self.capacity:
+                arr[:self.size] = getattr(self, name)[:self.size]
+            setattr(self, name, arr)
+        free = np.zeros(capacity, dtype=np.int64)
+        free[:self.nfree] = self._free[:self.nfree]
+        self._free = free
+        self.capacity = capacity
+
+    def _reserve(self, n):
+        '''Make room for n slots past size'''
+        if self.size+n > self.capacity:
+            self._grow(max(2*self.capacity, self.size+n))
+
+    def _claim(self, n):
+        '''Slots for n new photons, recycled ones first'''
+        if self.nfree == self.size:
+            self.size = 0
+            self.nfree = 0
+        recycled = min(n, self.nfree)
+        self.nfree -= recycled
+        slots = self._free[self.nfree:self.nfree+recycled].copy()
+        self._reserve(n-recycled)
+        fresh = np.arange(self.size, self.size+n-recycled)
+        self.size += len(fresh)
+        return np.concatenate([slots, fresh])
+
+    def _release(self, slots):
+        '''Kill the photons in `slots`, if they aren't already, and put
+        their slots on the free list
+        '''
+        slots = slots[self.alive[slots]]
+        self.alive[slots] = False
+        self._free[self.nfree:self.nfree+len(slots)] = slots
+        self.nfree += len(slots)
+
+    def clear(self):
+        self.alive[:self.size] = False
+        self.size = 0
+        self.nfree = 0
+
+    def live(self):
+        '''Slot indices of every photon still in flight'''
+        return np.flatnonzero(self.alive[:self.size])
+
+    def emit(self, x, y, theta, v, wavelength, polarization, ids):
+        '''Add photons; scalar arguments are broadcast. Returns their slots.'''
+        x, y, theta, v, wavelength, polarization, ids = np.broadcast_arrays(
+                x, y, theta, v, wavelength, polarization, ids)
+        slots = self._claim(x.size)
+        self.ids[slots] = ids.ravel()
+        self.x[slots] = x.ravel()
+        self.y[slots] = y.ravel()
+        self.theta[slots] = theta.ravel()
+        self.v[slots] = v.ravel()
+        self.vx[slots] = np.cos(self.theta[slots])*self.v[slots]
+        self.vy[slots] = np.sin(self.theta[slots])*self.v[slots]
+        self.wavelength[slots] = wavelength.ravel()
+        self.polarization[slots] = polarization.ravel()
+        self.bounces[slots] = 0
+        self.layer[slots] = self.stack.locate(self.y[slots])
+        self.launched_down[slots] = self.vy[slots] < 0
+        self.alive[slots] = True
+        return slots
+
+    def step(self):
+        '''Advance every live photon by one tick, the vectorized equivalent of
+        Particle.update. Returns the slots of photons that left the bounds.
+        '''
+        live = self.live()
+        if self.stack.contiguous:
+            self._cross_next_interface(live)
+        else:
+            self._check_for_change_layers(live)
+        self.x[live] += self.vx[live]
+        self.y[live] += self.vy[live]
+        x = self.x[live]
+        y = self.y[live]
+        if self.stack.contiguous:
+            #a full step can carry a photon past another interface
+            layer = self.layer[live]
+            stale = (y >= self.stack.tops[layer+1]) | \
+                    (y < self.stack.bottoms[layer+1])
+            self.layer[live[stale]] = self.stack.locate(y[stale])
+        xmin, xmax, ymin, ymax = self.bounds
+        gone = live[(x > xmax) | (x < xmin) | (y > ymax) | (y < ymin)]
+        self._release(gone)
+        return gone
+
+    def advance(self):
+        '''Move every live photon straight to its next event: the interface
+        ahead of it, where it reflects or refracts, or the edge of the bounds,
+        where it leaves. Returns the slots of photons that left.
+        '''
+        if not self.stack.contiguous:
+            raise ValueError("advance() needs contiguous layers")
+        live = self.live()
+        x = self.x[live]
+        y = self.y[live]
+        vx = self.vx[live]
+        vy = self.vy[live]
+        layer = self.layer[live]
+        down = vy < 0
+        last = len(self.stack)
+        iface = np.where(down, layer+1, layer)
+        has_iface = (vy != 0) & (iface >= 0) & (iface <= last)
+        iface = np.clip(iface, 0, last)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t_iface = np.where(has_iface, (self.stack.interfaces[iface]-y)/vy,
+                    np.inf)
+            t_exit = np.minimum(self._time_to_edge(x, vx, *self.bounds[:2]),
+                    self._time_to_edge(y, vy, *self.bounds[2:]))
+
+        exiting = t_exit <= t_iface
+        gone = live[exiting]
+        self.x[gone] += self.vx[gone]*t_exit[exiting]
+        self.y[gone] += self.vy[gone]*t_exit[exiting]
+        self._release(gone)
+
+        crossing = ~exiting
+        idx = live[crossing]
+        iface = iface[crossing]
+        down = down[crossing]
+        #only an interface between two layers of the stack refracts, the
+        #outer faces of the first and last layer are crossed freely
+        event = np.where(down, iface < last, iface > 0)
+        free = idx[~event]
+        self.x[free] += self.vx[free]*t_iface[crossing][~event]
+        self.y[free] = self.stack.interfaces[iface[~event]]
+        self.layer[free] = np.where(down[~event], iface[~event],
+                iface[~event]-1)
+
+        idx = idx[event]
+        entering = np.where(down[event], iface[event], iface[event]-1)
+        reflect = self._interact(idx, entering, down[event])
+        self.y[idx] = self.stack.interfaces[iface[event]]
+        self.layer[idx[~reflect]] = entering[~reflect]
+        return gone
+
+    @staticmethod
+    def _time_to_edge(pos, vel, low, high):
+        return np.where(vel > 0, (high-pos)/vel,
+                np.where(vel < 0, (low-pos)/vel, np.inf))
+
+    def _cross_next_interface(self, live):
+        layer = self.layer[live]
+        y = self.y[live]
+        vy = self.vy[live]
+        ynext = y+vy
+        down = vy < 0
+        boundary = np.where(down, self.stack.bottoms[layer+1],
+                self.stack.tops[layer+1])
+        entering = np.where(down, layer+1, layer-1)
+        hit = np.where(down, (y > boundary) & (ynext < boundary),
+                (vy > 0) & (y < boundary) & (ynext > boundary))
+        hit &= (entering >= 0) & (entering < len(self.stack))
+        idx = live[hit]
+        entering = entering[hit]
+        reflect = self._interact(idx, entering, down[hit])
+        self.layer[idx[~reflect]] = entering[~reflect]
+
+    def _check_for_change_layers(self, live):
+        #any layer list: test every layer, O(len(layers)) per photon
+        y = self.y[live][:, None]
+        vy = self.vy[live][:, None]
+        ynext = y+vy
+        from_above = (vy < 0) & (y > self.stack.y0) & (ynext < self.stack.y0)
+        from_below = (vy > 0) & (y < self.stack.yf) & (ynext > self.stack.yf)
+        hit_above = from_above.any(axis=1)
+        hit_below = from_below.any(axis=1)
+        #the nearest crossing is the first layer going down, the last going up
+        layer = np.where(hit_above, from_above.argmax(axis=1),
+                len(self.stack)-1-from_below[:, ::-1].argmax(axis=1))
+        hit = hit_above | hit_below
+        self._interact(live[hit], layer[hit], hit_above[hit])
+
+    def _interact(self, idx, layer, from_above):
+        '''Fresnel coin flip for photons at the boundary of `layer`, then
+        reflect or refract each one. Returns which of them reflected.
+        '''
+        if len(idx) == 0:
+            return np.zeros(0, dtype=bool)
+        r, new_sin, n_in, n = self._reflectance(idx, layer, from_above)
+        reflect = self.rng.random(len(idx)) < r
+        #moveToNewLayer reflects anything it can't refract
+        trapped = ~((-1 < new_sin) & (new_sin < 1))
+        reflect |= trapped
+        self._count_interactions(reflect, trapped)
+        boundary = np.where(from_above, self.stack.y0[layer], self.stack.yf[layer])
+        self._reflect(idx[reflect], boundary[reflect])
+        refract = ~reflect
+        self._refract(idx[refract], boundary[refract], new_sin[refract],
+                n_in[refract], n[refract], from_above[refract])
+        return reflect
+
+    def _count_interactions(self, reflect, trapped):
+        if self.profiler is not None:
+            self.profiler.count('interface_hits', len(reflect))
+            self.profiler.count('reflections', int(np.count_nonzero(reflect)))
+            self.profiler.count('total_internal_reflections',
+                    int(np.count_nonzero(trapped)))
+
+    def _reflectance(self, idx, layer, from_above):
+        '''Fresnel reflectance of photons idx at the boundary of `layer`,
+        with the new_sin, n_in and n it was worked out from
+        '''
+        n, nprev, nnext = self.stack.ns_for_lambdas(layer, self.wavelength[idx])
+        n_in = np.where(from_above, nprev, nnext)
+        theta = self.theta[idx]
+        new_sin = n_in*(np.sin(np.pi/2-theta))/n
+        if self.reflectance_cache is None:
+            r = fresnel_reflectance(theta, new_sin, n/n_in, from_above,
+                    self.polarization[idx])
+        else:
+            r = self.reflectance_cache.lookup(layer, from_above,
+                    self.polarization[idx], self.wavelength[idx], theta)
+        return r, new_sin, n_in, n
+
+    def _move_to(self, idx, boundary):
+        pct_move = (boundary-self.y[idx])/self.vy[idx]
+        self.y[idx] += self.vy[idx]*pct_move
+        self.x[idx] += self.vx[idx]*pct_move
+
+    def _reflect(self, idx, boundary):
+        self.bounces[idx] += 1
+        self._move_to(idx, boundary)
+        self.theta[idx] = -self.theta[idx]
+        self.vx[idx] = np.cos(self.theta[idx])*self.v[idx]
+        self.vy[idx] = np.sin(self.theta[idx])*self.v[idx]
+
+    def _refract(self, idx, boundary, new_sin, n_in, n, from_above):
+        self._move_to(idx, boundary)
+        theta = np.pi/2-np.arcsin(new_sin)
+        self.theta[idx] = np.where(from_above, theta, -theta)
+        self.v[idx] = self.v[idx]*n_in/n
+        self.vx[idx] = np.cos(self.theta[idx])*self.v[idx]
+        self.vy[idx] = np.sin(self.theta[idx])*self.v[idx]
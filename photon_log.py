@@ -0,0 +1,144 @@
+"""Streaming log of every photon that leaves the simulation.
+
+A log is a small JSON header followed by fixed-size PHOTON_RECORD rows,
+so it can be appended to in chunks while a run is going and memory-mapped
+as one structured array afterwards:
+
+    >>> log = read_photon_log('run.mcrlog')
+    >>> log['bounces'][log['side'] == REFLECTED].mean()
+"""
+import json
+import os
+import struct
+import numpy as np
+
+MAGIC = b'MCRLOG\x00\x01'
+#the header is padded so the records start on this boundary
+ALIGN = 64
+
+REFLECTED = 0
+TRANSMITTED = 1
+
+#exit_angle is the direction of travel when leaving, in radians
+PHOTON_RECORD = np.dtype([
+    ('id', '<i8'),
+    ('wavelength', '<f8'),
+    ('polarization', 'i1'),
+    ('side', 'i1'),
+    ('bounces', '<i4'),
+    ('exit_x', '<f8'),
+    ('exit_y', '<f8'),
+    ('exit_angle', '<f8'),
+])
+
+
+def exit_sides(launched_down, vy):
+    '''REFLECTED for photons leaving towards the side they were launched
+    from, TRANSMITTED for the rest
+    '''
+    reflected = np.where(launched_down, vy > 0, vy < 0)
+    return np.where(reflected, REFLECTED, TRANSMITTED)
+
+
+def _header():
+    descr = json.dumps({'descr': PHOTON_RECORD.descr}).encode()
+    length = len(MAGIC)+4+len(descr)
+    padding = -length % ALIGN
+    return MAGIC+struct.pack('<I', len(descr)+padding)+descr+b' '*padding
+
+
+def _read_header(f):
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError("{} is not a photon log".format(f.name))
+    length, = struct.unpack('<I', f.read(4))
+    header = json.loads(f.read(length).decode())
+    dtype = np.dtype([tuple(field) for field in header['descr']])
+    if dtype != PHOTON_RECORD:
+        raise ValueError("{} has an unknown record layout".format(f.name))
+    return len(MAGIC)+4+length
+
+
+class PhotonLogWriter(object):
+    """Buffers exiting photons and appends them to a log chunk_size records
+    at a time. mode='a' adds to an existing log instead of replacing it.
+    """
+    def __init__(self, path, chunk_size=65536, mode='w'):
+        self.path = path
+        if mode == 'a' and os.path.exists(path):
+            with open(path, 'rb') as f:
+                _read_header(f)
+            self._file = open(path, 'ab')
+        else:
+            self._file = open(path, 'wb')
+            self._file.write(_header())
+        self._buffer = np.zeros(chunk_size, dtype=PHOTON_RECORD)
+        self._buffered = 0
+        self.written = 0
+
+    def write(self, photons, slots):
+        '''Record the photons of a PhotonBatch in `slots`, which have just
+        left it
+        '''
+        self.write_arrays(photons.ids[slots], photons.wavelength[slots],
+                photons.polarization[slots], photons.bounces[slots],
+                photons.x[slots], photons.y[slots], photons.vx[slots],
+                photons.vy[slots], photons.launched_down[slots])
+
+    def write_arrays(self, ids, wavelength, polarization, bounces, x, y, vx,
+            vy, launched_down):
+        '''Record photons that have just left, given as one array (or list)
+        per attribute, e.g. gathered from departing Particles
+        '''
+        ids, wavelength, polarization, bounces, x, y, vx, vy, launched_down = \
+                (np.asarray(column) for column in (ids, wavelength,
+                    polarization, bounces, x, y, vx, vy, launched_down))
+        start = 0
+        while start < len(ids):
+            chunk = slice(start, start+len(self._buffer)-self._buffered)
+            rows = self._buffer[self._buffered:self._buffered+len(ids[chunk])]
+            rows['id'] = ids[chunk]
+            rows['wavelength'] = wavelength[chunk]
+            rows['polarization'] = polarization[chunk]
+            rows['side'] = exit_sides(launched_down[chunk], vy[chunk])
+            rows['bounces'] = bounces[chunk]
+            rows['exit_x'] = x[chunk]
+            rows['exit_y'] = y[chunk]
+            rows['exit_angle'] = np.arctan2(vy[chunk], vx[chunk])
+            self._buffered += len(rows)
+            start += len(rows)
+            if self._buffered == len(self._buffer):
+                self.flush()
+
+    def flush(self):
+        self._file.write(self._buffer[:self._buffered].tobytes())
+        self._file.flush()
+        self.written += self._buffered
+        self._buffered = 0
+
+    def close(self):
+        if not self._file.closed:
+            self.flush()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_photon_log(path, mmap=True):
+    '''The records of a photon log as a structured array, memory-mapped
+    unless mmap is False. A record still being written is left out.
+    '''
+    with open(path, 'rb') as f:
+        offset = _read_header(f)
+    count = (os.path.getsize(path)-offset)//PHOTON_RECORD.itemsize
+    if not mmap:
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            return np.fromfile(f, dtype=PHOTON_RECORD, count=count)
+    if count == 0:
+        return np.zeros(0, dtype=PHOTON_RECORD)
+    return np.memmap(path, dtype=PHOTON_RECORD, mode='r', offset=offset,
+            shape=(count,))
@@ -0,0 +1,87 @@
+"""Opt-in timers and counters for the simulation's hot paths.
+
+Nothing is measured unless a Profiler is handed to the code doing the
+work: a PhotonBatch or Simulation given profiler= counts interface hits,
+reflections and total internal reflections, and the GUI times each part
+of a frame once profiling is turned on from its File menu.
+
+    >>> from stack import buildLayers
+    >>> from simulation import Simulation
+    >>> profiler = Profiler()
+    >>> Simulation(buildLayers([1.33]), profiler=profiler).run(10000)
+    >>> profiler.report()
+"""
+import collections
+import contextlib
+import json
+import time
+
+
+@contextlib.contextmanager
+def timed(profiler, name):
+    '''Add the time spent in the block to profiler's timer `name`, or do
+    nothing if profiler is None
+    '''
+    if profiler is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profiler.add_time(name, time.perf_counter()-start)
+
+
+class Profiler(object):
+    """Cumulative timers, as [seconds, calls] by name, and counters by name.
+    Calling frame() once per frame samples the counters, so rates() can
+    give per second rates over the last `window` frames.
+    """
+    def __init__(self, window=30):
+        self.window = window
+        self.reset()
+
+    def reset(self):
+        self.timers = {}
+        self.counters = {}
+        self.started = time.perf_counter()
+        self._samples = collections.deque(maxlen=self.window)
+
+    def add_time(self, name, seconds):
+        timer = self.timers.setdefault(name, [0., 0])
+        timer[0] += seconds
+        timer[1] += 1
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0)+amount
+
+    def frame(self):
+        self.count('frames')
+        self._samples.append((time.perf_counter(), dict(self.counters)))
+
+    def rates(self):
+        '''Per second rate of each counter over the recent frames, e.g.
+        rates()['frames'] is the frame rate
+        '''
+        if len(self._samples) < 2:
+            return {}
+        (t0, first), (t1, last) = self._samples[0], self._samples[-1]
+        if t1 <= t0:
+            return {}
+        return {name: (count-first.get(name, 0))/(t1-t0)
+                for name, count in last.items()}
+
+    def report(self):
+        '''Everything measured so far, as a JSON-able dict'''
+        return {
+            'elapsed': time.perf_counter()-self.started,
+            'timers': {name: {'seconds': seconds, 'calls': calls,
+                'mean_seconds': seconds/calls}
+                for name, (seconds, calls) in self.timers.items()},
+            'counters': dict(self.counters),
+            'rates': self.rates(),
+        }
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
@@ -0,0 +1,93 @@
+"""Random numbers drawn from a numpy Generator in blocks.
+
+Code that wants one random number at a time, like Particle's Fresnel coin
+flip or the GUI emitting a photon per tick, pays numpy's per-call overhead
+on every draw. A RandomBuffer fills a block of doubles in one call and
+hands them out from a list, refilling when it runs dry.
+
+The doubles come out in exactly the order the generator makes them, so a
+RandomBuffer(seed) gives the numbers np.random.default_rng(seed).random()
+would, however the draws are split into scalars and arrays.
+
+    >>> rng = RandomBuffer(seed=1, bit_generator='Philox')
+    >>> rng.random(), rng.random(3), rng.integers(400, 680)
+"""
+import numpy as np
+
+#numpy bit generators by name; PCG64 is np.random.default_rng's
+BIT_GENERATORS = {
+    'PCG64': np.random.PCG64,
+    'PCG64DXSM': np.random.PCG64DXSM,
+    'Philox': np.random.Philox,
+    'SFC64': np.random.SFC64,
+}
+
+
+def make_generator(seed=None, bit_generator='PCG64'):
+    '''np.random.Generator on the named bit generator, seeded with
+    anything np.random.default_rng accepts
+    '''
+    if bit_generator not in BIT_GENERATORS:
+        raise ValueError("unknown bit generator {!r}".format(bit_generator))
+    return np.random.Generator(BIT_GENERATORS[bit_generator](seed))
+
+
+class RandomBuffer(object):
+    """Uniform doubles from `generator`, or a new one made by
+    make_generator(seed, bit_generator), block_size at a time. random()
+    and integers() follow the Generator methods of the same name, so a
+    RandomBuffer can stand in for the rng of a PhotonBatch.
+    """
+    def __init__(self, seed=None, bit_generator='PCG64', block_size=4096,
+            generator=None):
+        if generator is None:
+            generator = make_generator(seed, bit_generator)
+        self.generator = generator
+        self.block_size = block_size
+        self._block = []
+        self._pos = 0
+
+    def _refill(self):
+        self._block = self.generator.random(self.block_size).tolist()
+        self._pos = 0
+
+    def random(self, size=None):
+        '''A float in [0, 1), or an array of `size` of them'''
+        if size is None:
+            if self._pos == len(self._block):
+                self._refill()
+            self._pos += 1
+            return self._block[self._pos-1]
+        out = np.empty(size)
+        flat = out.reshape(-1)
+        #what's left of the block first, then straight from the generator
+        #for anything bigger than a block
+        buffered = min(flat.size, len(self._block)-self._pos)
+        flat[:buffered] = self._block[self._pos:self._pos+buffered]
+        self._pos += buffered
+        rest = flat.size-buffered
+        if rest >= self.block_size:
+            flat[buffered:] = self.generator.random(rest)
+        elif rest:
+            self._refill()
+            flat[buffered:] = self._block[:rest]
+            self._pos = rest
+        return out
+
+    def integers(self, low, high, size=None):
+        '''Integers in [low, high), from the same stream of doubles. They
+        aren't the numbers Generator.integers would give.
+        '''
+        if size is None:
+            return low+int(self.random()*(high-low))
+        return low+(self.random(size)*(high-low)).astype(np.int64)
+
+    def get_state(self):
+        '''The generator's state and the doubles still in the block'''
+        return {'generator': self.generator.bit_generator.state,
+                'block': self._block[self._pos:]}
+
+    def set_state(self, state):
+        self.generator.bit_generator.state = state['generator']
+        self._block = list(state['block'])
+        self._pos = 0
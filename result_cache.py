@@ -0,0 +1,152 @@
+"""Content-addressed cache of simulation results.
+
+A result is keyed by a hash of everything that decides it: the stack's
+layers down to the last bit of each float, the source angle, the
+wavelength mode, the seed and the run settings. Entries are kept in a
+least-recently-used dict in memory and, with a directory, as JSON files
+that outlive the process. Cached counts are a starting point, not just an
+answer: cached_run() only simulates the photons a cached entry is missing.
+
+    >>> from stack import buildLayers
+    >>> cache = ResultCache(directory='results')
+    >>> cached_run(buildLayers([1.33]), 10**6, seed=1, cache=cache)
+    >>> cached_run(buildLayers([1.33]), 2*10**6, seed=1, cache=cache)
+"""
+import collections
+import hashlib
+import json
+import os
+import tempfile
+import numpy as np
+from stack import as_stack
+from runner import SHARD_SIZE, merge_counts, run_sharded
+
+#bump when a change to the engines changes what a key's results would be
+CACHE_VERSION = 1
+
+
+def _canonical(value):
+    #floats by their exact bits, so 0.1+0.2 and 0.3 are different stacks
+    if isinstance(value, float):
+        return value.hex()
+    if isinstance(value, dict):
+        return {str(key): _canonical(value[key]) for key in sorted(value)}
+    if isinstance(value, (list, tuple)):
+        return [_canonical(v) for v in value]
+    if isinstance(value, np.random.SeedSequence):
+        return _canonical({'entropy': value.entropy,
+            'spawn_key': value.spawn_key, 'pool_size': value.pool_size})
+    if hasattr(value, 'tolist'):
+        return _canonical(value.tolist())
+    return value
+
+
+def config_key(layers, angle, wavelength_spec, seed, **settings):
+    '''Hex digest identifying the results of a configuration. Layers are
+    hashed by value, so separately built but identical stacks share a key.
+    `settings` holds anything else results depend on, e.g. nbuckets.
+    '''
+    stack = as_stack(layers)
+    config = {
+        'version': CACHE_VERSION,
+        'layers': [stack.n, stack.y0, stack.yf, stack.nprev, stack.nnext,
+            stack.dndlambda],
+        'angle': float(angle),
+        'wavelength_spec': wavelength_spec,
+        'seed': seed,
+        'settings': settings,
+    }
+    text = json.dumps(_canonical(config), sort_keys=True,
+            separators=(',', ':'))
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class ResultCache(object):
+    """Results by config_key: an LRU of up to maxsize entries in memory,
+    backed by one JSON file per key in `directory` if one is given. An
+    entry is a JSON-able dict, e.g. {'photons': ..., 'counts': {...}}.
+    """
+    def __init__(self, maxsize=128, directory=None):
+        self.maxsize = maxsize
+        self.directory = directory
+        self._entries = collections.OrderedDict()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries or (self.directory is not None and
+                os.path.exists(self._path(key)))
+
+    def _path(self, key):
+        return os.path.join(self.directory, key+'.json')
+
+    def get(self, key, default=None):
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return self._entries[key]
+        if self.directory is not None and os.path.exists(self._path(key)):
+            with open(self._path(key)) as f:
+                entry = json.load(f)
+            self._remember(key, entry)
+            return entry
+        return default
+
+    def put(self, key, entry):
+        self._remember(key, entry)
+        if self.directory is not None:
+            #write then rename, so a crash never leaves half an entry
+            fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entry, f)
+            os.replace(tmp, self._path(key))
+
+    def _remember(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def keys(self):
+        '''Keys held in memory, least recently used first'''
+        return list(self._entries)
+
+    def clear(self):
+        '''Forget the in-memory entries; files on disk are kept'''
+        self._entries.clear()
+
+
+def cached_run(layers, n_photons, angle=45, wavelength_spec='monochrome',
+        seed=None, cache=None, workers=None, shard_size=SHARD_SIZE,
+        nbuckets=5, propagation='event'):
+    '''runner.run_sharded, resumed from the cache. A seeded run is cut
+    into the same shards however far it goes, so an entry for fewer
+    photons is extended by running only the missing shards, and the result
+    is the same as running n_photons from scratch. Unseeded runs are
+    extended with fresh photons instead.
+    '''
+    if cache is None:
+        cache = ResultCache()
+    key = config_key(layers, angle, wavelength_spec, seed,
+            nbuckets=nbuckets, propagation=propagation,
+            shard_size=shard_size)
+    entry = cache.get(key)
+    if entry is not None and entry['photons'] == n_photons:
+        return dict(entry['counts'])
+    if (entry is None or entry['photons'] > n_photons or
+            (seed is not None and entry['photons'] % shard_size)):
+        entry = {'photons': 0, 'counts': None}
+    if seed is None:
+        counts = run_sharded(layers, n_photons-entry['photons'], angle,
+                wavelength_spec, None, workers, shard_size, nbuckets,
+                propagation)
+    else:
+        counts = run_sharded(layers, n_photons, angle, wavelength_spec, seed,
+                workers, shard_size, nbuckets, propagation,
+                first_photon=entry['photons'])
+    if entry['counts'] is not None:
+        merge_counts(entry['counts'], counts)
+    cache.put(key, {'photons': n_photons, 'counts': counts})
+    return dict(counts)
@@ -0,0 +1,77 @@
+"""Sharded Monte Carlo runs across a process pool.
+
+Photons are cut into fixed-size shards and shard i draws from the i-th
+child of SeedSequence(seed). Neither depends on how many workers there
+are, so a seed gives the same histogram at any worker count.
+
+With the 'spawn' start method (the default on Windows and macOS) call
+run_sharded from under an `if __name__ == '__main__':` guard.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from simulation import Simulation, reflection_counts
+from stack import plain_layers
+
+SHARD_SIZE = 100000
+
+
+def shard_seeds(seed, start, stop):
+    '''SeedSequences for shards [start, stop), the same children that
+    SeedSequence(seed).spawn(stop) would hand out
+    '''
+    root = seed if isinstance(seed, np.random.SeedSequence) else \
+            np.random.SeedSequence(seed)
+    return [np.random.SeedSequence(root.entropy,
+        spawn_key=root.spawn_key+(i,), pool_size=root.pool_size)
+        for i in range(start, stop)]
+
+
+def run_shard(layers, n_photons, angle, wavelength_spec, seed, first_id,
+        nbuckets=5, propagation='event'):
+    sim = Simulation(layers, angle, wavelength_spec, seed, nbuckets,
+            propagation=propagation, first_id=first_id)
+    return sim.run(n_photons, batch_size=n_photons)
+
+
+def _run_shard(args):
+    return run_shard(*args)
+
+
+def merge_counts(counts, into):
+    for key in counts:
+        into[key] += counts[key]
+    return into
+
+
+def run_sharded(layers, n_photons, angle=45, wavelength_spec='monochrome',
+        seed=None, workers=None, shard_size=SHARD_SIZE, nbuckets=5,
+        propagation='event', first_photon=0):
+    '''simulate() split over `workers` processes (all cores by default).
+    Returns the merged reflection counts. first_photon, a multiple of
+    shard_size, skips the shards before it: adding the counts of a run up
+    to first_photon gives the counts of the whole run.
+    '''
+    if first_photon % shard_size:
+        raise ValueError("first_photon must be a multiple of shard_size")
+    layers = plain_layers(layers)
+    first = first_photon//shard_size
+    nshards = -(-n_photons//shard_size)
+    seeds = shard_seeds(seed, first, nshards)
+    tasks = []
+    for i in range(first, nshards):
+        first_id = i*shard_size
+        size = min(shard_size, n_photons-first_id)
+        tasks.append((layers, size, angle, wavelength_spec, seeds[i-first],
+            first_id, nbuckets, propagation))
+
+    merged = reflection_counts(nbuckets)
+    if workers == 1 or len(tasks) <= 1:
+        for counts in map(_run_shard, tasks):
+            merge_counts(counts, merged)
+        return merged
+    workers = min(workers or os.cpu_count(), len(tasks))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for counts in pool.map(_run_shard, tasks):
+            merge_counts(counts, merged)
+    return merged
@@ -0,0 +1,228 @@
+"""Headless Monte Carlo runs.
+
+Nothing here imports PyQt5 or matplotlib, so runs can go on machines
+without a display. Layer stacks come from stack.buildLayers, or from
+artists.buildLayers when a GUI stack is already at hand.
+
+    >>> from stack import buildLayers
+    >>> from simulation import simulate
+    >>> simulate(buildLayers([1.33]), 100000, angle=30, seed=1)
+"""
+import numpy as np
+from stack import LAMBDA0, LAMBDAf, VACCUM_SPEED, as_stack
+from fresnel import reflectance_cache
+from photon_batch import PhotonBatch, bucket_key, tally_bounces
+from photon_log import PhotonLogWriter
+from confidence import Z95, converged, photons_needed, relative_errors
+from profiling import timed
+from random_buffer import make_generator
+
+#the GUI's monochromatic wavelength, in nm
+MONOCHROME = 670
+
+
+def reflection_counts(nbuckets=5):
+    '''An empty histogram keyed like ApplicationWindow.reflection_counts'''
+    return {bucket_key(i, nbuckets): 0 for i in range(nbuckets)}
+
+
+def source_pose(angle):
+    '''Position and direction of a source on the unit circle, for an angle
+    in degrees from the normal as shown in the GUI's "Initial Angle" label.
+    Angles past 90° put the source below the stack.
+    '''
+    theta = np.pi/2-np.deg2rad(angle)
+    return np.cos(theta), np.sin(theta), theta
+
+
+def sample_wavelengths(rng, wavelength_spec, count):
+    '''Draw `count` wavelengths. `wavelength_spec` is 'monochrome',
+    'broadband' (integers in [LAMBDA0, LAMBDAf) like the GUI), a single
+    wavelength, or a sequence of wavelengths to choose from uniformly.
+    '''
+    if isinstance(wavelength_spec, str):
+        if wavelength_spec == 'monochrome':
+            return np.full(count, float(MONOCHROME))
+        elif wavelength_spec == 'broadband':
+            return rng.integers(LAMBDA0, LAMBDAf, count).astype(float)
+        raise ValueError("unknown wavelength spec {!r}".format(wavelength_spec))
+    choices = np.asarray(wavelength_spec, dtype=float)
+    if choices.ndim == 0:
+        return np.full(count, float(choices))
+    return rng.choice(choices, count)
+
+
+class Simulation(object):
+    """A stack, a source and the photons emitted from it so far.
+
+    Photons leave the source like the GUI's add_particle_at_source, ids
+    (counting up from first_id) alternating polarization, and are binned
+    by bounces as they exit.
+    With propagation='event' each step jumps every photon to its next
+    interface; 'step' moves them by the GUI's fixed ticks instead, and
+    'jit' runs every photon out in one step through jit_kernel's compiled
+    loops. Without a reflectance_resolution, 'jit' gives exactly the
+    photons and counts of 'event', with or without numba.
+    A reflectance_resolution reads reflectances from a
+    fresnel.ReflectanceCache of that resolution instead of evaluating them.
+    Exiting photons are also written to photon_log, a
+    photon_log.PhotonLogWriter, and counted in spectrum, a
+    spectral.SpectralHistogram, if they are given. A profiling.Profiler
+    times each step and counts what happens in it. bit_generator names the
+    random_buffer.BIT_GENERATORS entry seed is given to; PCG64 draws what
+    np.random.default_rng(seed) would.
+    """
+    def __init__(self, layers, angle=45, wavelength_spec='monochrome',
+            seed=None, nbuckets=5, bounds=(-1, 1, -1, 1),
+            propagation='event', first_id=0, reflectance_resolution=None,
+            photon_log=None, spectrum=None, profiler=None,
+            bit_generator='PCG64'):
+        if propagation not in ('event', 'step', 'jit'):
+            raise ValueError("unknown propagation {!r}".format(propagation))
+        self.layers = layers
+        self.stack = as_stack(layers)
+        self.propagation = propagation
+        self.angle = angle
+        self.wavelength_spec = wavelength_spec
+        #every draw here is already a whole array, so unlike the GUI it
+        #gains nothing from a random_buffer.RandomBuffer
+        self.rng = make_generator(seed, bit_generator)
+        cache = None
+        if reflectance_resolution:
+            cache = reflectance_cache(self.stack, reflectance_resolution)
+        batch_class = PhotonBatch
+        if propagation == 'jit':
+            #numba takes a while to import, only load it when asked for
+            from jit_kernel import JitBatch as batch_class
+        self.photons = batch_class(self.stack, bounds=bounds, rng=self.rng,
+                reflectance_cache=cache, profiler=profiler)
+        self.reflection_counts = reflection_counts(nbuckets)
+        self.x, self.y, self.theta = source_pose(angle)
+        layer = self.stack.layer_at(self.y)
+        self.n0 = layer.n if layer is not None else 1
+        self.first_id = first_id
+        self.emitted = 0
+        self.photon_log = photon_log
+        self.spectrum = spectrum
+        self.profiler = profiler
+
+    def emit(self, count):
+        ids = self.first_id+np.arange(self.emitted, self.emitted+count)
+        wavelengths = sample_wavelengths(self.rng, self.wavelength_spec, count)
+        self.photons.emit(self.x, self.y, self.theta, -VACCUM_SPEED/self.n0,
+                wavelengths, ids%2, ids)
+        self.emitted += count
+
+    def step(self):
+        with timed(self.profiler, 'step'):
+            if self.propagation in ('event', 'jit'):
+                gone = self.photons.advance()
+            else:
+                gone = self.photons.step()
+        if self.profiler is not None:
+            self.profiler.count('exited', len(gone))
+        self._tally(gone)
+        if self.photon_log is not None:
+            self.photon_log.write(self.photons, gone)
+        return gone
+
+    def _tally(self, gone):
+        tally_bounces(self.reflection_counts, self.photons.bounces[gone])
+        if self.spectrum is not None:
+            self.spectrum.add_photons(self.photons, gone)
+
+    def run(self, n_photons, batch_size=100000):
+        '''Emit and follow photons until n_photons have left the stack.
+        At most batch_size are in flight at once.
+        '''
+        target = self.emitted+n_photons
+        while self.emitted < target:
+            self.emit(min(batch_size, target-self.emitted))
+            while len(self.photons):
+                self.step()
+        return self.reflection_counts
+
+    def relative_errors(self, z=Z95):
+        '''Relative half-width of each bucket's Wilson interval'''
+        return relative_errors(self.reflection_counts, z)
+
+    def run_until(self, epsilon, max_photons, batch_size=100000, z=Z95,
+            buckets=None, min_batch=1000):
+        '''Run batches until the relative error of every bucket in
+        `buckets` (all of them by default) is at most epsilon, or
+        max_photons have been emitted. Each batch is sized from the current
+        errors to land just past the target rather than far beyond it.
+        Returns the reflection counts and whether they converged.
+        '''
+        start = self.emitted
+        size = min_batch
+        while self.emitted-start < max_photons:
+            self.run(min(size, batch_size, max_photons-self.emitted+start),
+                    batch_size)
+            errors = self.relative_errors(z)
+            if converged(errors, epsilon, buckets):
+                return self.reflection_counts, True
+            done = self.emitted-start
+            needed = photons_needed(errors, epsilon, done, buckets)
+            #unknown while a bucket is empty: keep doubling
+            size = max(min_batch, done if needed is None else needed-done)
+        return self.reflection_counts, False
+
+
+def open_sides(bounds):
+    '''Whether bounds let photons run sideways forever, the geometry of
+    transfer_matrix's analytic results
+    '''
+    return bounds[0] == -np.inf and bounds[1] == np.inf
+
+
+def simulate(layers, n_photons, angle=45, wavelength_spec='monochrome',
+        seed=None, batch_size=100000, nbuckets=5, propagation='event',
+        reflectance_resolution=None, photon_log=None, spectrum=None,
+        bit_generator='PCG64', bounds=(-1, 1, -1, 1)):
+    '''Run n_photons through `layers` and return their reflection counts.
+    `seed` is anything np.random.default_rng accepts, seeding the
+    bit_generator named (see Simulation). Every photon is also
+    written to the photon log file at path photon_log and counted in the
+    spectral.SpectralHistogram spectrum, if given.
+    propagation='analytic' skips the simulation and returns the expected
+    counts from transfer_matrix.expected_counts instead. Those are for
+    sides that go on forever, so it needs bounds with infinite x limits,
+    e.g. (-np.inf, np.inf, -1, 1); photons trapped by total internal
+    reflection never leave such bounds when simulated.
+    '''
+    if propagation == 'analytic':
+        if not open_sides(bounds):
+            raise ValueError("analytic counts are for unbounded sides, "
+                    "not x bounds {}".format(tuple(bounds[:2])))
+        if photon_log or spectrum is not None:
+            raise ValueError("analytic runs have no photons to log")
+        #transfer_matrix builds on this module
+        from transfer_matrix import expected_counts
+        return expected_counts(layers, n_photons, angle, wavelength_spec,
+                nbuckets)
+    log = PhotonLogWriter(photon_log) if photon_log else None
+    sim = Simulation(layers, angle, wavelength_spec, seed, nbuckets, bounds,
+            propagation=propagation,
+            reflectance_resolution=reflectance_resolution, photon_log=log,
+            spectrum=spectrum, bit_generator=bit_generator)
+    try:
+        return sim.run(n_photons, batch_size)
+    finally:
+        if log is not None:
+            log.close()
+
+
+def simulate_until(layers, epsilon, max_photons, angle=45,
+        wavelength_spec='monochrome', seed=None, batch_size=100000,
+        nbuckets=5, propagation='event', reflectance_resolution=None,
+        z=Z95, buckets=None):
+    '''simulate() until every bucket's relative error is at most epsilon
+    or max_photons are spent, see Simulation.run_until. Returns the counts,
+    their Wilson relative errors and whether they converged.
+    '''
+    sim = Simulation(layers, angle, wavelength_spec, seed, nbuckets,
+            propagation=propagation,
+            reflectance_resolution=reflectance_resolution)
+    counts, done = sim.run_until(epsilon, max_photons, batch_size, z, buckets)
+    return counts, sim.relative_errors(z), done
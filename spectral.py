@@ -0,0 +1,135 @@
+"""Wavelength-resolved tallies of the photons leaving a stack.
+
+A SpectralHistogram counts exiting photons by wavelength bin, bounce
+bucket and side, so one broadband run gives the whole reflectance
+spectrum and how each wavelength's bounces are spread:
+
+    >>> from stack import buildLayers
+    >>> from simulation import simulate
+    >>> spectrum = SpectralHistogram()
+    >>> simulate(buildLayers([1.33, 1.6]), 10**6, wavelength_spec='broadband',
+    ...         spectrum=spectrum)
+    >>> spectrum.reflectance()
+"""
+import numpy as np
+from stack import LAMBDA0, LAMBDAf
+from photon_batch import bucket_key
+from photon_log import REFLECTED, TRANSMITTED, exit_sides
+
+
+class SpectralHistogram(object):
+    """counts[i, b, side] is the number of photons with wavelength in
+    [edges[i], edges[i+1]) that left on `side` (photon_log.REFLECTED or
+    TRANSMITTED) after b bounces, the last bucket collecting everything at
+    or above it. The default edges give one bin per nm of the broadband
+    range. Use a float dtype to add weighted photons.
+    """
+    def __init__(self, edges=None, nbuckets=5, dtype=np.int64):
+        if edges is None:
+            edges = np.arange(LAMBDA0, LAMBDAf+1)
+        self.edges = np.asarray(edges, dtype=float)
+        self.nbuckets = nbuckets
+        self.counts = np.zeros((len(self.edges)-1, nbuckets, 2), dtype=dtype)
+
+    @property
+    def centers(self):
+        return (self.edges[:-1]+self.edges[1:])/2
+
+    def clear(self):
+        self.counts[...] = 0
+
+    def add(self, wavelength, bounces, side, weights=None):
+        '''Count photons given as arrays; wavelengths outside every bin are
+        dropped
+        '''
+        wavelength = np.asarray(wavelength, dtype=float)
+        bins = np.searchsorted(self.edges, wavelength, side='right')-1
+        inside = (bins >= 0)&(bins < len(self.counts))
+        bucket = np.minimum(np.asarray(bounces, dtype=np.int64),
+                self.nbuckets-1)
+        flat = (bins*self.nbuckets+bucket)*2+np.asarray(side)
+        if weights is not None:
+            weights = np.asarray(weights, dtype=float)[inside]
+        binned = np.bincount(flat[inside], weights, minlength=self.counts.size)
+        self.counts += binned.reshape(self.counts.shape).astype(
+                self.counts.dtype)
+
+    def add_photons(self, photons, slots, weights=None):
+        '''Count the photons of a PhotonBatch in `slots`, which have just
+        left it
+        '''
+        self.add(photons.wavelength[slots], photons.bounces[slots],
+                exit_sides(photons.launched_down[slots], photons.vy[slots]),
+                weights)
+
+    def merge(self, other):
+        '''Add the counts of another histogram with the same bins'''
+        if (not np.array_equal(self.edges, other.edges) or
+                self.nbuckets != other.nbuckets):
+            raise ValueError("can only merge histograms with the same bins")
+        self.counts += other.counts.astype(self.counts.dtype)
+        return self
+
+    def totals(self):
+        '''Photons counted in each bin'''
+        return self.counts.sum(axis=(1, 2))
+
+    def reflectance(self):
+        '''Fraction of each bin's photons that were reflected, nan for
+        empty bins
+        '''
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.counts[:, :, REFLECTED].sum(axis=1)/self.totals()
+
+    def bounce_fractions(self, side=None):
+        '''Fraction of each bin's photons in each bounce bucket, shape
+        (bins, nbuckets), counting one side only if `side` is given
+        '''
+        counts = self.counts.sum(axis=2) if side is None else \
+                self.counts[:, :, side]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return counts/self.totals()[:, None]
+
+    def save(self, path):
+        '''Write the histogram to an .npz file, see load()'''
+        np.savez(path, edges=self.edges, counts=self.counts)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            spectrum = cls(data['edges'], data['counts'].shape[1],
+                    data['counts'].dtype)
+            spectrum.counts[...] = data['counts']
+        return spectrum
+
+    def to_csv(self, path):
+        '''One row per bin: its edges, then a count column for each side
+        and bounce bucket
+        '''
+        names = ["{}_{}".format(side, bucket_key(b, self.nbuckets))
+                for side in ('reflected', 'transmitted')
+                for b in range(self.nbuckets)]
+        columns = np.column_stack([self.edges[:-1], self.edges[1:],
+            self.counts[:, :, REFLECTED], self.counts[:, :, TRANSMITTED]])
+        fmt = ['%g', '%g']+['%d' if self.counts.dtype.kind == 'i' else '%g']*\
+                len(names)
+        np.savetxt(path, columns, fmt=fmt, delimiter=',', comments='',
+                header=','.join(['wavelength_low', 'wavelength_high']+names))
+
+    def plot(self, ax=None):
+        '''Plot the reflectance and each bounce bucket's share against
+        wavelength, on a new figure unless `ax` is given
+        '''
+        if ax is None:
+            import matplotlib.pyplot as plt
+            ax = plt.figure().add_subplot(111)
+        centers = self.centers
+        fractions = self.bounce_fractions()
+        for b in range(self.nbuckets):
+            ax.plot(centers, fractions[:, b],
+                    label="{} bounces".format(bucket_key(b, self.nbuckets)))
+        ax.plot(centers, self.reflectance(), 'k', label="reflected")
+        ax.set_xlabel("wavelength (nm)")
+        ax.set_ylabel("fraction of photons")
+        ax.legend()
+        return ax
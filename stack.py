@@ -0,0 +1,222 @@
+"""Layer stack geometry and dispersion, with no GUI dependencies."""
+import bisect
+import numpy as np
+
+LAMBDA0 = 400
+LAMBDAf = 680
+VACCUM_SPEED = 0.04
+
+
+#integer wavelengths the GUI's broadband source draws from
+WAVELENGTHS = np.arange(LAMBDA0,LAMBDAf)
+
+
+def disperse(n, wavelength, dndlambda):
+    '''Vectorized Layer.ns_for_lambda for a single index: n at the given
+    wavelength(s), never dropping below 1. Vacuum (n == 1) never disperses.
+    '''
+    n = np.asarray(n, dtype=float)
+    pos = np.maximum(1, n+(wavelength-LAMBDA0)*dndlambda)
+    neg = np.maximum(1, n+(LAMBDAf-wavelength)*-dndlambda)
+    return np.where(n == 1, 1., np.where(dndlambda > 0, pos, neg))
+
+
+class Layer(object):
+    #no per-instance __dict__, subclasses add one unless they declare
+    #__slots__ too
+    __slots__ = ('n','nprev','nnext','y0','yf','dndlambda','_ns_table',
+            '__weakref__')
+
+    def __init__(self,n,y0,yf,nprev = 1,nnext = 1,dndlambda=1e-3):
+        self.n = n
+        self.nprev = nprev
+        self.nnext = nnext
+        self.y0 = y0
+        self.yf = yf
+        #per nm
+        self.dndlambda = dndlambda
+        #(n, nprev, nnext) for each of WAVELENGTHS, filled on first use so
+        #stacks of thousands of layers stay cheap to build
+        self._ns_table = None
+
+    def contains(self,y):
+        return y >= self.yf and y < self.y0
+
+    def ns_for_lambda(self,lambda_):
+        if self._ns_table is None:
+            self._ns_table = list(zip(*[disperse(n_,WAVELENGTHS,
+                self.dndlambda).tolist() for n_ in (self.n,self.nprev,self.nnext)]))
+        i = lambda_-LAMBDA0
+        if i == int(i) and 0 <= i < len(self._ns_table):
+            return self._ns_table[int(i)]
+
+        def new_n_pos(n):
+            return max(1,n+(lambda_-LAMBDA0)*self.dndlambda)
+        def new_n_neg(n):
+            return max(1,n+(LAMBDAf-lambda_)*-self.dndlambda)
+        
+        new_n = new_n_pos if self.dndlambda > 0 else new_n_neg
+        n = 1 if self.n == 1 else new_n(self.n)
+        nprev = 1 if self.nprev == 1 else new_n(self.nprev) 
+        nnext = 1 if self.nnext == 1 else new_n(self.nnext)
+        return n,nprev,nnext
+
+
+class LayerStack(object):
+    """A list of layers plus the arrays the photon engines look them up in.
+
+    Everything is computed once at construction, so build a new LayerStack
+    whenever the layers or their dispersion change.
+    """
+    def __init__(self,layers):
+        self.layers = list(layers)
+        def column(name):
+            return np.array([getattr(layer,name) for layer in self.layers],
+                    dtype=float)
+        self.y0 = column('y0')
+        self.yf = column('yf')
+        self.n = column('n')
+        self.nprev = column('nprev')
+        self.nnext = column('nnext')
+        self.dndlambda = column('dndlambda')
+        #interface k is the top of layer k, the last one the bottom of the stack
+        self.interfaces = np.append(self.y0,self.yf[-1:])
+        self.contiguous = (np.array_equal(self.yf[:-1],self.y0[1:]) and
+                bool(np.all(np.diff(self.interfaces) < 0)))
+        #top and bottom of layer k are at [k+1], for k from -1 (above the
+        #stack) to len(layers) (below it)
+        self.tops = np.append(np.inf,self.interfaces)
+        self.bottoms = np.append(self.interfaces,-np.inf)
+        self._ascending = self.interfaces[::-1].copy()
+        self._tops = self.tops.tolist()
+        self._bottoms = self.bottoms.tolist()
+        self._ascending_list = self._ascending.tolist()
+        #ns_table[:,k,i] is (n, nprev, nnext) of layer k at WAVELENGTHS[i]
+        d = self.dndlambda[:,None]
+        self.ns_table = np.stack([disperse(ns[:,None],WAVELENGTHS,d)
+            for ns in (self.n,self.nprev,self.nnext)])
+        #fresnel.ReflectanceCache tables by resolution, see
+        #fresnel.reflectance_cache
+        self.reflectance_caches = {}
+
+    def __len__(self):
+        return len(self.layers)
+
+    def __iter__(self):
+        return iter(self.layers)
+
+    def __getitem__(self,i):
+        return self.layers[i]
+
+    def locate(self,y):
+        '''Index of the layer containing each y, -1 above the stack and
+        len(layers) below it. Contiguous stacks are searched by bisection.
+        '''
+        y = np.asarray(y,dtype=float)
+        if self.contiguous:
+            return len(self.layers)-np.searchsorted(self._ascending,y,
+                    side='right')
+        inside = (y[...,None] >= self.yf)&(y[...,None] < self.y0)
+        return np.where(inside.any(axis=-1),inside.argmax(axis=-1),
+                np.where(y >= self.y0[0],-1,len(self.layers)))
+
+    def layer_index(self,y,hint=None):
+        '''locate() for one y. `hint` is a previous answer, which is
+        returned as is while y is still inside that layer.
+        '''
+        if self.contiguous:
+            if (hint is not None and 
+                    self._bottoms[hint+1] <= y < self._tops[hint+1]):
+                return hint
+            return len(self.layers)-bisect.bisect_right(
+                    self._ascending_list,y)
+        return int(self.locate(y))
+
+    def layer_at(self,y):
+        '''The layer containing y, or None outside the stack'''
+        k = self.layer_index(y)
+        return self.layers[k] if 0 <= k < len(self.layers) else None
+
+    def ns_for_lambdas(self,layer,wavelength):
+        '''Batched Layer.ns_for_lambda: (n, nprev, nnext) arrays for each
+        pair of layer index and wavelength. Wavelengths off the integer
+        grid are computed directly.
+        '''
+        layer = np.asarray(layer)
+        wavelength = np.asarray(wavelength,dtype=float)
+        col = wavelength-LAMBDA0
+        on_grid = (col == np.floor(col))&(col >= 0)&(col < len(WAVELENGTHS))
+        ns = self.ns_table[:,layer,np.where(on_grid,col,0).astype(np.intp)]
+        if not on_grid.all():
+            off = ~on_grid
+            d = self.dndlambda[layer[off]]
+            for i,base in enumerate((self.n,self.nprev,self.nnext)):
+                ns[i][off] = disperse(base[layer[off]],wavelength[off],d)
+        return ns[0],ns[1],ns[2]
+
+
+def as_stack(layers):
+    return layers if isinstance(layers,LayerStack) else LayerStack(layers)
+
+
+def buildLayers(ns,dndlambda=0.001,layer_class=Layer,thicknesses=None,
+        depth=.96):
+    '''Air, a layer for each index in ns from y=0 down, then air again.
+    Without thicknesses the layers split `depth` evenly. Otherwise they are
+    scaled to fill `depth` in proportion to their thicknesses, or laid out
+    at exactly those thicknesses if depth is None.
+    '''
+    if thicknesses is None:
+        ys = np.linspace(0,-depth,1+len(ns))
+    else:
+        thicknesses = np.asarray(thicknesses,dtype=float)
+        if len(thicknesses) != len(ns) or (thicknesses <= 0).any():
+            raise ValueError("need one positive thickness per layer")
+        if depth is not None:
+            thicknesses = thicknesses*depth/thicknesses.sum()
+        ys = -np.concatenate([[0],np.cumsum(thicknesses)])
+    ys = ys.tolist()
+    layers = [layer_class(1,1,0,1,ns[0],dndlambda)]
+    for i,n in enumerate(ns):
+        prev_n = 1 if i == 0 else ns[i-1]
+        next_n = 1 if i == len(ns)-1 else ns[i+1]
+        layers.append(layer_class(n,ys[i],ys[i+1],prev_n,next_n,dndlambda))
+
+    layers.append(layer_class(1,ys[-1],ys[-1]-.04,ns[-1],1,dndlambda))
+
+    return layers
+
+
+def periodic(cell,repeats,chirp=0):
+    '''(ns, thicknesses) of `repeats` copies of cell, a list of (n, d)
+    layers, e.g. [(n1,d1),(n2,d2)] for a two layer mirror. A chirp stretches
+    the thicknesses of each period linearly, up to a factor of 1+chirp for
+    the last one.
+    '''
+    ns,ds = (np.array(col,dtype=float) for col in zip(*cell))
+    scale = np.linspace(1,1+chirp,repeats) if repeats > 1 else np.ones(1)
+    return (np.tile(ns,repeats).tolist(),
+            (scale[:,None]*ds).ravel().tolist())
+
+
+def bragg_mirror(n_high,n_low,pairs,design_wavelength=550,chirp=0):
+    '''periodic() quarter-wave stack of `pairs` high/low index pairs, with
+    thicknesses in nm for design_wavelength
+    '''
+    return periodic([(n_high,design_wavelength/(4*n_high)),
+        (n_low,design_wavelength/(4*n_low))],pairs,chirp)
+
+
+def graded(n_start,n_end,count,thickness=1.):
+    '''(ns, thicknesses) of `count` equally thick layers whose index steps
+    linearly from n_start to n_end
+    '''
+    return np.linspace(n_start,n_end,count).tolist(),[thickness]*count
+
+
+def plain_layers(layers):
+    '''Copies of `layers` as bare stack.Layer objects, e.g. to drop the
+    artists and canvas references of GUI layers before pickling
+    '''
+    return [Layer(layer.n,layer.y0,layer.yf,layer.nprev,layer.nnext,
+        layer.dndlambda) for layer in layers]
@@ -0,0 +1,138 @@
+"""Parameter sweeps over source angle, wavelength and layer indices.
+
+Every point of the grid is an independent run with its own photons and
+seed, so an angle-resolved reflectance curve doesn't mix angles the way
+the GUI's auto-move modes do:
+
+    >>> from sweep import sweep
+    >>> result = sweep(range(0, 90, 5), [450, 550, 650], [(1.33,), (1.5,)],
+    ...         10000, seed=1)
+    >>> result['reflectance'].shape
+    (18, 3, 2)
+
+Points run in a process pool (see runner.py about the `__main__` guard)
+and each worker builds the LayerStack of a layer tuple once, then reuses
+its tables for every point on it. Point i of the flattened grid draws from
+the i-th child of SeedSequence(seed), so results don't depend on the
+number of workers.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from stack import LayerStack, buildLayers
+from simulation import Simulation, open_sides
+from spectral import SpectralHistogram
+from runner import shard_seeds
+from photon_log import REFLECTED
+
+#stacks built so far in this process, by (layer indices, dndlambda)
+_stacks = {}
+
+
+def _stack(ns, dndlambda):
+    key = (tuple(ns), dndlambda)
+    if key not in _stacks:
+        _stacks[key] = LayerStack(buildLayers(list(ns), dndlambda))
+    return _stacks[key]
+
+
+def run_points(ns, dndlambda, points, n_photons, nbuckets=5,
+        propagation='event', bounds=(-1, 1, -1, 1)):
+    '''Run each (angle, wavelength_spec, seed) of `points` on the stack of
+    `ns` within `bounds`. Returns their counts, each indexed [side, bucket] with side
+    photon_log.REFLECTED or TRANSMITTED.
+    '''
+    stack = _stack(ns, dndlambda)
+    counts = []
+    for angle, wavelength_spec, seed in points:
+        spectrum = SpectralHistogram([-np.inf, np.inf], nbuckets)
+        sim = Simulation(stack, angle, wavelength_spec, seed, nbuckets,
+                bounds, propagation=propagation, spectrum=spectrum)
+        sim.run(n_photons)
+        counts.append(spectrum.counts[0].T)
+    return counts
+
+
+def _run_points(args):
+    return run_points(*args)
+
+
+def _analytic(stack_ns, angles, wavelengths, n_photons, dndlambda, nbuckets):
+    #transfer_matrix builds on simulation, like sweep
+    from transfer_matrix import _wavelength_weights, solve
+    counts = np.zeros((len(angles), len(wavelengths), len(stack_ns), 2,
+        nbuckets))
+    for s, ns in enumerate(stack_ns):
+        stack = _stack(ns, dndlambda)
+        for a, angle in enumerate(angles):
+            for w, spec in enumerate(wavelengths):
+                values, weights = _wavelength_weights(spec)
+                bounces = solve(stack, angle, values, nbuckets)['bounces']
+                counts[a, w, s] = n_photons*np.einsum('spwb,w->sb', bounces,
+                        weights)/2
+    return counts
+
+
+def sweep(angles, wavelengths, stack_ns, n_photons, dndlambda=0.001,
+        seed=None, workers=None, nbuckets=5, propagation='event',
+        chunk_size=None, bounds=(-1, 1, -1, 1)):
+    '''Run n_photons at every point of the grid angles x wavelengths x
+    stack_ns. Angles are degrees from the normal as in simulation.Simulation,
+    wavelengths anything it takes as a wavelength_spec, and stack_ns a list
+    of layer index tuples for stack.buildLayers. Photons run within
+    `bounds`, as in simulation.Simulation. propagation='analytic' fills the
+    grid with transfer_matrix expectations instead, which are for sides
+    that go on forever, so it needs bounds with infinite x limits like
+    (-np.inf, np.inf, -1, 1). The same bounds give Monte Carlo results of
+    the same model.
+
+    Returns a dict with the axes and 'counts', indexed [angle, wavelength,
+    stack, side, bucket], 'reflectance', the reflected fraction at each
+    [angle, wavelength, stack], and the 'bounds' they were found for.
+    '''
+    angles = list(angles)
+    wavelengths = list(wavelengths)
+    stack_ns = [tuple(ns) for ns in stack_ns]
+    shape = (len(angles), len(wavelengths), len(stack_ns))
+    if propagation == 'analytic':
+        if not open_sides(bounds):
+            raise ValueError("analytic counts are for unbounded sides, "
+                    "not x bounds {}".format(tuple(bounds[:2])))
+        counts = _analytic(stack_ns, angles, wavelengths, n_photons,
+                dndlambda, nbuckets)
+    else:
+        counts = np.zeros(shape+(2, nbuckets), dtype=np.int64)
+        seeds = shard_seeds(seed, 0, int(np.prod(shape)))
+        workers = workers or os.cpu_count()
+        if chunk_size is None:
+            chunk_size = max(1, -(-int(np.prod(shape))//(4*workers)))
+        #each task stays on one stack so its tables are built once per worker
+        tasks = []
+        indices = []
+        for s, ns in enumerate(stack_ns):
+            points = [(a, w) for a in range(len(angles))
+                    for w in range(len(wavelengths))]
+            for start in range(0, len(points), chunk_size):
+                chunk = points[start:start+chunk_size]
+                indices.append([(a, w, s) for a, w in chunk])
+                tasks.append((ns, dndlambda, [(angles[a], wavelengths[w],
+                    seeds[np.ravel_multi_index((a, w, s), shape)])
+                    for a, w in chunk], n_photons, nbuckets, propagation,
+                    bounds))
+        if workers == 1 or len(tasks) <= 1:
+            results = map(_run_points, tasks)
+        else:
+            with ProcessPoolExecutor(max_workers=min(workers,
+                    len(tasks))) as pool:
+                results = list(pool.map(_run_points, tasks))
+        for index, result in zip(indices, results):
+            for point, point_counts in zip(index, result):
+                counts[point] = point_counts
+    return {
+        'angles': np.asarray(angles),
+        'wavelengths': wavelengths,
+        'stacks': stack_ns,
+        'counts': counts,
+        'bounds': tuple(bounds),
+        'reflectance': counts[..., REFLECTED, :].sum(axis=-1)/n_photons,
+    }
@@ -0,0 +1,297 @@
+"""Analytic reference for the Monte Carlo engine.
+
+Every photon in a planar stack meets a sequence of interfaces where it
+reflects with the Fresnel probability or refracts, so the ensemble result
+has a closed form: an incoherent (intensity) transfer-matrix calculation.
+solve() gives per-polarization, per-wavelength reflectance, transmittance
+and the expected bounce-count distribution of the photons leaving each
+side, and monte_carlo_error() compares a simulation against it:
+
+    python transfer_matrix.py
+
+The answer is for event-driven propagation in a stack of unlimited width:
+photons leaving through the sides of the simulation bounds, and those
+that skip a thin layer in one fixed tick, are not modelled.
+"""
+import numpy as np
+from stack import LAMBDA0, WAVELENGTHS, as_stack, buildLayers
+from fresnel import fresnel_reflectance
+from simulation import MONOCHROME, Simulation, reflection_counts, source_pose
+from photon_batch import bucket_key
+from photon_log import REFLECTED, TRANSMITTED, exit_sides
+
+
+def _wavelength_weights(wavelength_spec):
+    '''Distinct wavelengths and how often sample_wavelengths draws each'''
+    if isinstance(wavelength_spec, str):
+        if wavelength_spec == 'monochrome':
+            return np.array([float(MONOCHROME)]), np.ones(1)
+        elif wavelength_spec == 'broadband':
+            return WAVELENGTHS.astype(float), np.full(len(WAVELENGTHS),
+                    1./len(WAVELENGTHS))
+        raise ValueError("unknown wavelength spec {!r}".format(wavelength_spec))
+    choices, counts = np.unique(np.atleast_1d(np.asarray(wavelength_spec,
+        dtype=float)), return_counts=True)
+    return choices, counts/counts.sum()
+
+
+def _ns(stack, wavelengths):
+    '''(n, nprev, nnext) of every layer at each wavelength, shape (3, L, W)'''
+    col = wavelengths-LAMBDA0
+    if ((col == np.floor(col))&(col >= 0)&(col < len(WAVELENGTHS))).all():
+        return stack.ns_table[:, :, col.astype(np.intp)]
+    layer = np.repeat(np.arange(len(stack)), len(wavelengths))
+    ns = stack.ns_for_lambdas(layer, np.tile(wavelengths, len(stack)))
+    return np.reshape(ns, (3, len(stack), len(wavelengths)))
+
+
+#Bounce counts are tracked with truncated power series in z, a marker
+#multiplied in at every reflection: a[i] for i < nbuckets is the
+#probability of getting through with exactly i bounces and a[-1] is the
+#total over all bounce counts, i.e. the series evaluated at z = 1.
+
+def _series_mul(a, b):
+    c = np.zeros_like(a)
+    k = len(a)-1
+    for i in range(k):
+        c[i:k] += a[i]*b[:k-i]
+    c[k] = a[k]*b[k]
+    return c
+
+
+def _series_inv(a):
+    b = np.zeros_like(a)
+    k = len(a)-1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        b[0] = 1/a[0]
+        for n in range(1, k):
+            b[n] = -(a[1:n+1]*b[n-1::-1][:n]).sum(axis=0)/a[0]
+        #a[k] == 0 is a loop between two perfect reflectors, which nothing
+        #leaves: every path through it carries a zero transmission, so
+        #count it as 0 instead of letting inf*0 turn into nan
+        b[k] = np.where(a[k] == 0, 0, 1/a[k])
+    return b
+
+
+def _identity(nbuckets, shape):
+    '''Scattering series (r_down, t_down, r_up, t_up) of an empty stack'''
+    one = np.zeros((nbuckets+1,)+shape)
+    one[0] = one[-1] = 1
+    zero = np.zeros_like(one)
+    return zero, one, zero.copy(), one.copy()
+
+
+def _interface(p_down, p_up, nbuckets):
+    '''Scattering series of one interface that reflects photons coming
+    from above with probability p_down and from below with p_up
+    '''
+    r_down, t_down, r_up, t_up = _identity(nbuckets, p_down.shape)
+    if nbuckets > 1:
+        r_down[1] = p_down
+        r_up[1] = p_up
+    else:
+        r_down[0] = p_down
+        r_up[0] = p_up
+    r_down[-1] = p_down
+    r_up[-1] = p_up
+    t_down[0] = t_down[-1] = 1-p_down
+    t_up[0] = t_up[-1] = 1-p_up
+    return r_down, t_down, r_up, t_up
+
+
+def _star(top, bottom):
+    '''Scattering series of `top` stacked on `bottom`, summing over every
+    number of round trips between them
+    '''
+    r_down_a, t_down_a, r_up_a, t_up_a = top
+    r_down_b, t_down_b, r_up_b, t_up_b = bottom
+    loop = -_series_mul(r_up_a, r_down_b)
+    loop[0] += 1
+    loop[-1] += 1
+    loop = _series_inv(loop)
+    t_down = _series_mul(_series_mul(t_down_a, loop), t_down_b)
+    t_up = _series_mul(_series_mul(t_up_b, loop), t_up_a)
+    r_down = r_down_a+_series_mul(_series_mul(t_down_a, r_down_b),
+            _series_mul(loop, t_up_a))
+    r_up = r_up_b+_series_mul(_series_mul(t_up_b, r_up_a),
+            _series_mul(loop, t_down_b))
+    return r_down, t_down, r_up, t_up
+
+
+def _reflect_probability(theta, n_in, n_out, from_above, polarization):
+    '''Chance the coin flip of PhotonBatch._interact reflects, including
+    photons that can't refract
+    '''
+    new_sin = n_in*(np.sin(np.pi/2-theta))/n_out
+    r = fresnel_reflectance(theta, new_sin, n_out/n_in, from_above,
+            polarization)
+    return np.where(np.abs(new_sin) >= 1, 1., np.minimum(r, 1))
+
+
+def solve(layers, angle=45, wavelengths=MONOCHROME, nbuckets=5):
+    '''Exact ensemble result for photons from a source at `angle` (degrees
+    from the normal, like simulation.Simulation) at each of `wavelengths`.
+
+    Returns a dict of arrays indexed [polarization, wavelength]:
+    'reflectance' and 'transmittance' are the fractions of photons leaving
+    on the source's side and the far side, 'trapped' the rest, which bounce
+    forever by total internal reflection. 'bounces' is the distribution of
+    bounce counts of the photons that leave, indexed [side, polarization,
+    wavelength, bucket] with side photon_log.REFLECTED or TRANSMITTED and
+    the last bucket collecting everything at or above it.
+    '''
+    stack = as_stack(layers)
+    if not stack.contiguous:
+        raise ValueError("the transfer-matrix solver needs contiguous layers")
+    wavelengths = np.atleast_1d(np.asarray(wavelengths, dtype=float))
+    count = len(stack)
+    x, y, theta0 = source_pose(angle)
+    #v is negative, so sin(theta) > 0 moves down
+    down = bool(np.sin(theta0) > 0)
+    source = int(np.clip(stack.layer_index(y), 0, count-1))
+    n, nprev, nnext = _ns(stack, wavelengths)
+
+    #|cos(theta)| of a photon in each layer, carried across each interface
+    #by Snell's law the way _refract does it
+    u = np.empty((count, len(wavelengths)))
+    u[source] = abs(np.cos(theta0))
+    for k in range(source+1, count):
+        u[k] = nprev[k]*u[k-1]/n[k]
+    for k in range(source-1, -1, -1):
+        u[k] = nnext[k]*u[k+1]/n[k]
+    #past a totally reflecting interface u means nothing, keep it finite
+    theta = np.arccos(np.minimum(u, 1))
+
+    #interface j, for 0 < j < count, is between layers j-1 and j; the outer
+    #faces of the stack are crossed freely
+    polarization = np.arange(2)[:, None, None]
+    inner = slice(1, count)
+    above = slice(0, count-1)
+    p_down = _reflect_probability(theta[above], nprev[inner], n[inner],
+            True, polarization)
+    p_up = _reflect_probability(-theta[inner], nnext[above], n[above],
+            False, polarization)
+    def fold(interfaces):
+        system = _identity(nbuckets, (2, len(wavelengths)))
+        for i, j in enumerate(interfaces):
+            face = _interface(p_down[:, j-1], p_up[:, j-1], nbuckets)
+            system = _star(system, face) if i else face
+        return system
+    top = fold(range(1, source+1))
+    bottom = fold(range(source+1, count))
+
+    #photons start between the two halves, heading into one of them
+    loop = -_series_mul(top[2], bottom[0])
+    loop[0] += 1
+    loop[-1] += 1
+    loop = _series_inv(loop)
+    if down:
+        exit_top = _series_mul(_series_mul(bottom[0], loop), top[3])
+        exit_bottom = _series_mul(loop, bottom[1])
+    else:
+        exit_top = _series_mul(loop, top[3])
+        exit_bottom = _series_mul(_series_mul(top[2], loop), bottom[1])
+    reflected, transmitted = ((exit_top, exit_bottom) if down else
+            (exit_bottom, exit_top))
+
+    bounces = np.empty((2, 2, len(wavelengths), nbuckets))
+    for side, series in ((REFLECTED, reflected), (TRANSMITTED, transmitted)):
+        head = np.moveaxis(series[:nbuckets-1], 0, -1)
+        bounces[side, ..., :nbuckets-1] = head
+        bounces[side, ..., nbuckets-1] = series[-1]-head.sum(axis=-1)
+    return {
+        'wavelength': wavelengths,
+        'reflectance': reflected[-1],
+        'transmittance': transmitted[-1],
+        'trapped': np.maximum(0, 1-reflected[-1]-transmitted[-1]),
+        'bounces': bounces,
+    }
+
+
+def expected_counts(layers, n_photons, angle=45, wavelength_spec='monochrome',
+        nbuckets=5):
+    '''Expected reflection_counts of simulation.simulate with unbounded
+    sides, bounds=(-np.inf, np.inf, ...), as floats, with polarizations
+    split evenly and wavelengths weighted like sample_wavelengths draws
+    them. Photons trapped by total internal reflection, which never leave
+    such a simulation, are not counted. With the default bounds photons
+    also leave through the sides, so these are not its counts.
+    '''
+    wavelengths, weights = _wavelength_weights(wavelength_spec)
+    bounces = solve(layers, angle, wavelengths, nbuckets)['bounces']
+    fractions = np.einsum('spwb,w->b', bounces, weights)/2
+    counts = reflection_counts(nbuckets)
+    for i, fraction in enumerate(fractions):
+        counts[bucket_key(i, nbuckets)] = n_photons*float(fraction)
+    return counts
+
+
+def monte_carlo_error(layers, n_photons, angle=45,
+        wavelength_spec='monochrome', seed=None, nbuckets=5,
+        batch_size=100000, reflectance_resolution=None, max_bounces=1000):
+    '''Run n_photons through an event-driven Simulation with unbounded
+    sides and compare the fraction reflected, the fraction trapped and
+    each bounce bucket with the analytic result. With no sides to leave
+    through, a photon trapped by total internal reflection would bounce
+    forever, so photons are dropped and counted as trapped once they have
+    bounced max_bounces times. z scores are in units of the binomial
+    standard error; much above 4 points to a bug rather than noise.
+    '''
+    stack = as_stack(layers)
+    bounds = (-np.inf, np.inf, stack.interfaces[-1], stack.interfaces[0])
+    sim = Simulation(stack, angle, wavelength_spec, seed, nbuckets, bounds,
+            reflectance_resolution=reflectance_resolution)
+    reflected = 0
+    trapped = 0
+    while sim.emitted < n_photons:
+        sim.emit(min(batch_size, n_photons-sim.emitted))
+        while len(sim.photons):
+            gone = sim.step()
+            sides = exit_sides(sim.photons.launched_down[gone],
+                    sim.photons.vy[gone])
+            reflected += int(np.count_nonzero(sides == REFLECTED))
+            live = sim.photons.live()
+            stuck = live[sim.photons.bounces[live] >= max_bounces]
+            sim.photons._release(stuck)
+            trapped += len(stuck)
+
+    wavelengths, weights = _wavelength_weights(wavelength_spec)
+    solution = solve(stack, angle, wavelengths, nbuckets)
+    expected = dict(reflection_counts(nbuckets))
+    expected['reflected'] = float(weights@solution['reflectance'].mean(axis=0))
+    expected['trapped'] = float(weights@solution['trapped'].mean(axis=0))
+    fractions = np.einsum('spwb,w->b', solution['bounces'], weights)/2
+    observed = {'reflected': reflected/n_photons,
+        'trapped': trapped/n_photons}
+    for i, fraction in enumerate(fractions):
+        key = bucket_key(i, nbuckets)
+        expected[key] = float(fraction)
+        observed[key] = sim.reflection_counts[key]/n_photons
+    z = {}
+    for key, p in expected.items():
+        se = np.sqrt(max(p*(1-p), 1e-300)/n_photons)
+        z[key] = (observed[key]-p)/se
+    return {
+        'photons': n_photons,
+        'analytic': expected,
+        'monte_carlo': observed,
+        'abs_error': {key: abs(observed[key]-expected[key])
+            for key in expected},
+        'z_score': z,
+        'max_abs_z': max(abs(v) for v in z.values()),
+    }
+
+
+if __name__ == '__main__':
+    import time
+    for ns in ([1.33], [1.33, 1.6, 1.2], [2.3, 1.38]*20):
+        for angle in (30, 75):
+            start = time.perf_counter()
+            solve(buildLayers(ns), angle)
+            elapsed = time.perf_counter()-start
+            report = monte_carlo_error(buildLayers(ns), 200000, angle,
+                    'broadband', seed=0)
+            print("{} layers at {}°: solved in {:.0f} µs, R = {:.4f}, "
+                "Monte Carlo max |z| = {:.2f}".format(len(ns), angle,
+                    1e6*elapsed, report['analytic']['reflected'],
+                    report['max_abs_z']))
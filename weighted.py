@@ -0,0 +1,190 @@
+"""Weighted photons, a variance-reduction mode for rare outcomes.
+
+Instead of a coin flip deciding whether a photon reflects, every photon
+hitting an interface splits in two: a reflected branch carrying R of its
+weight and a transmitted one carrying the rest. Only branches of at least
+split_weight split, lighter ones flip the usual coin, which caps the
+number of branches a photon can have in flight. Branches whose weight
+drops below roulette_weight play Russian roulette, surviving with weight
+survival_weight or dying, which keeps the tallies unbiased while ending
+branches not worth following. High-bounce buckets
+then collect a little weight from nearly every photon rather than a whole
+photon from a few, so they converge with far fewer histories:
+
+    >>> from stack import buildLayers
+    >>> from weighted import simulate_weighted
+    >>> counts, intervals = simulate_weighted(buildLayers([1.33]), 10000)
+"""
+import numpy as np
+from photon_batch import PhotonBatch, bucket_key, tally_bounces
+from simulation import Simulation
+
+
+class WeightedBatch(PhotonBatch):
+    """A PhotonBatch whose photons split at every interface. `ids` is
+    shared by all the branches of one emitted photon.
+    """
+
+    FIELDS = PhotonBatch.FIELDS+(('weight', np.float64),)
+
+    def __init__(self, layers, capacity=256, bounds=(-1, 1, -1, 1),
+            rng=np.random, reflectance_cache=None, split_weight=1e-3,
+            roulette_weight=1e-5, survival_weight=1e-4, profiler=None):
+        PhotonBatch.__init__(self, layers, capacity, bounds, rng,
+                reflectance_cache, profiler)
+        self.split_weight = split_weight
+        self.roulette_weight = roulette_weight
+        self.survival_weight = survival_weight
+
+    def emit(self, x, y, theta, v, wavelength, polarization, ids):
+        slots = PhotonBatch.emit(self, x, y, theta, v, wavelength,
+                polarization, ids)
+        self.weight[slots] = 1
+        return slots
+
+    #branches killed by the roulette have no weight left, drop them from
+    #the photons that leave
+    def step(self):
+        gone = PhotonBatch.step(self)
+        return gone[self.weight[gone] > 0]
+
+    def advance(self):
+        gone = PhotonBatch.advance(self)
+        return gone[self.weight[gone] > 0]
+
+    def _clone(self, slots):
+        #new slots go past size rather than on free ones, so the slot
+        #indices step() and advance() are holding stay valid
+        count = len(slots)
+        self._reserve(count)
+        copies = np.arange(self.size, self.size+count)
+        for name, _ in self.FIELDS:
+            arr = getattr(self, name)
+            arr[copies] = arr[slots]
+        self.size += count
+        return copies
+
+    def _interact(self, idx, layer, from_above):
+        if len(idx) == 0:
+            return np.zeros(0, dtype=bool)
+        r, new_sin, n_in, n = self._reflectance(idx, layer, from_above)
+        trapped = ~((-1 < new_sin) & (new_sin < 1))
+        r = np.where(trapped, 1., np.minimum(r, 1))
+        boundary = np.where(from_above, self.stack.y0[layer], self.stack.yf[layer])
+        heavy = self.weight[idx] >= self.split_weight
+        reflect = np.where(heavy, r >= 1, self.rng.random(len(idx)) < r)
+        split = heavy & (r > 0) & (r < 1)
+        self._count_interactions(reflect | split, trapped)
+        copies = self._clone(idx[split])
+        self.weight[copies] *= r[split]
+        self.weight[idx[split]] *= 1-r[split]
+        self._reflect(idx[reflect], boundary[reflect])
+        self._reflect(copies, boundary[split])
+        refract = ~reflect
+        self._refract(idx[refract], boundary[refract], new_sin[refract],
+                n_in[refract], n[refract], from_above[refract])
+        self._roulette(np.concatenate([idx, copies]))
+        return reflect
+
+    def _roulette(self, idx):
+        low = idx[self.weight[idx] < self.roulette_weight]
+        survive = self.rng.random(len(low))*self.survival_weight < \
+                self.weight[low]
+        self.weight[low[survive]] = self.survival_weight
+        self.weight[low[~survive]] = 0
+        self._release(low[~survive])
+
+
+class WeightedSimulation(Simulation):
+    """A Simulation of weighted photons. reflection_counts holds the
+    estimated count for each bucket, a float, and confidence_intervals()
+    bounds them from the spread of the emitted photons' scores. A spectrum
+    needs a float dtype to hold the weights.
+    """
+    def __init__(self, layers, angle=45, wavelength_spec='monochrome',
+            seed=None, nbuckets=5, bounds=(-1, 1, -1, 1),
+            propagation='event', first_id=0, reflectance_resolution=None,
+            split_weight=1e-3, roulette_weight=1e-5, survival_weight=1e-4,
+            spectrum=None, profiler=None):
+        Simulation.__init__(self, layers, angle, wavelength_spec, seed,
+                nbuckets, bounds, propagation, first_id,
+                reflectance_resolution, spectrum=spectrum, profiler=profiler)
+        self.photons = WeightedBatch(self.stack, bounds=bounds, rng=self.rng,
+                reflectance_cache=self.photons.reflectance_cache,
+                split_weight=split_weight, roulette_weight=roulette_weight,
+                survival_weight=survival_weight, profiler=profiler)
+        self.reflection_counts = {key: 0. for key in self.reflection_counts}
+        self.nbuckets = nbuckets
+        #per bucket sums of the finished photons' scores and their squares
+        self._sum = np.zeros(nbuckets)
+        self._sum_sq = np.zeros(nbuckets)
+        self._finished = 0
+        #scores of photons first_id+_open_from onwards, some still in flight
+        self._open_from = 0
+        self._scores = np.zeros((0, nbuckets))
+
+    def emit(self, count):
+        if len(self.photons) == 0:
+            self._close_scores()
+        self._scores = np.concatenate([self._scores,
+            np.zeros((count, self.nbuckets))])
+        Simulation.emit(self, count)
+
+    def _close_scores(self):
+        self._sum += self._scores.sum(axis=0)
+        self._sum_sq += (self._scores**2).sum(axis=0)
+        self._finished += len(self._scores)
+        self._open_from = self.emitted
+        self._scores = np.zeros((0, self.nbuckets))
+
+    def _tally(self, gone):
+        bounces = self.photons.bounces[gone]
+        weights = self.photons.weight[gone]
+        tally_bounces(self.reflection_counts, bounces, weights)
+        if self.spectrum is not None:
+            self.spectrum.add_photons(self.photons, gone, weights)
+        rows = self.photons.ids[gone]-self.first_id-self._open_from
+        np.add.at(self._scores, (rows, np.minimum(bounces, self.nbuckets-1)),
+                weights)
+
+    def confidence_intervals(self, z=1.96):
+        '''reflection_counts style dict of (low, high) bounds on each
+        bucket's expected count over the photons emitted so far, from the
+        normal approximation with z standard errors
+        '''
+        n = self._finished+len(self._scores)
+        total = self._sum+self._scores.sum(axis=0)
+        mean = total/max(n, 1)
+        sum_sq = self._sum_sq+(self._scores**2).sum(axis=0)
+        var = np.maximum(0, sum_sq/max(n, 1)-mean**2)*n/max(n-1, 1)
+        half = z*np.sqrt(var/max(n, 1))
+        return {bucket_key(i, self.nbuckets): (n*(mean[i]-half[i]),
+            n*(mean[i]+half[i])) for i in range(self.nbuckets)}
+
+    def relative_errors(self, z=1.96):
+        '''Half-width of each bucket's confidence interval over its estimate'''
+        errors = {}
+        for key, (low, high) in self.confidence_intervals(z).items():
+            estimate = self.reflection_counts[key]
+            errors[key] = (high-low)/2/estimate if estimate else np.inf
+        return errors
+
+
+def simulate_weighted(layers, n_photons, angle=45,
+        wavelength_spec='monochrome', seed=None, batch_size=10000,
+        nbuckets=5, propagation='event', reflectance_resolution=None,
+        split_weight=1e-3, roulette_weight=1e-5, survival_weight=1e-4):
+    '''simulation.simulate with weighted photons. Returns the estimated
+    reflection counts and their 95% confidence intervals. Each photon can
+    have up to about 1/split_weight branches in flight, so batches are
+    smaller than simulate's by default; stacks where most photons bounce
+    many times anyway, like Bragg mirrors, run faster with a larger
+    split_weight.
+    '''
+    sim = WeightedSimulation(layers, angle, wavelength_spec, seed, nbuckets,
+            propagation=propagation,
+            reflectance_resolution=reflectance_resolution,
+            split_weight=split_weight, roulette_weight=roulette_weight,
+            survival_weight=survival_weight)
+    counts = sim.run(n_photons, batch_size)
+    return counts, sim.confidence_intervals()